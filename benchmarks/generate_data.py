@@ -0,0 +1,355 @@
+"""
+Generate a synthetic `Anomaly Publication.zip` with the layout and file formats of
+the real Datastream/Worldscope delivery, so the pipeline can be run and
+benchmarked without the proprietary data.
+
+The archive contains
+- wide daily Datastream CSVs (one row per security, 7 metadata columns followed
+  by one column per trading day) in the six "Daily ..." folders,
+- pipe-delimited Worldscope files `WS*_f_20250131.txt` without header, in the
+  column order of WS_FILE_COLUMNS (scripts/ws_ingestion.py): WSFV and the two
+  period files at full scale, every other file type with a few rows per company
+  for a sample of companies, so that `--ws-ingest all` converts all of them,
+- universal matching CSVs linking Datastream codes (DSCD) to Worldscope ids
+  (WC06105).
+
+Identifiers, fiscal periods and period items are consistent across the files,
+so the joins and filters of steps 05-16 keep a realistic share of the rows. The
+file layouts and the anomaly items come from the pipeline's own definitions, so
+the data follows them when they change.
+"""
+import argparse
+import csv
+import io
+import itertools
+import sys
+import zipfile
+from datetime import date, timedelta
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT_DIR / "scripts"))
+
+from anomaly_config import COLUMN_MAP
+from ws_ingestion import WS_FILE_COLUMNS, anomaly_items
+
+PREFIX = "Anomaly Publication/Data"
+WS_VINTAGE = "20250131"
+
+# (GEOGC, ISO numeric code, local currency)
+COUNTRIES = [
+    ("US", "840", "USD"), ("JP", "392", "JPY"), ("GB", "826", "GBP"), ("CN", "156", "CNY"),
+    ("IN", "356", "INR"), ("CA", "124", "CAD"), ("DE", "276", "EUR"), ("FR", "250", "EUR"),
+    ("AU", "036", "AUD"), ("KR", "410", "KRW"), ("HK", "344", "HKD"), ("TW", "158", "TWD"),
+    ("CH", "756", "CHF"), ("SE", "752", "SEK"), ("IT", "380", "EUR"), ("ES", "724", "EUR"),
+    ("BR", "076", "BRL"), ("ZA", "710", "ZAR"), ("SG", "702", "SGD"), ("VN", "704", "VND"),
+]
+
+DS_FOLDERS = {
+    "Daily Returns LC": "DailyReturnsLC",
+    "Daily Returns USD": "DailyReturnsUSD",
+    "Daily MV LC": "DailyMVLC",
+    "Daily MV USD": "DailyMVUSD",
+    "Daily Index Returns LC": "DailyIndexReturnsLC",
+    "Daily Index Returns USD": "DailyIndexReturnsUSD",
+}
+DS_META_COLUMNS = ["DATES", "NAME", "ISIN", "GEOGN", "CURRENCY", "BDATE", "TIME"]
+
+MATCHING_COLUMNS = ["Code", "Mnemonic", "DSCD", "NAME", "ISIN", "LOC", "GEOGC", "WC06105",
+                    "TIME", "NPCUR", "ISOCUR", "PCUR"]
+
+# Items used by the anomaly definitions (COLUMN_MAP first, then the other inputs)
+ANOMALY_ITEMS = list(COLUMN_MAP) + sorted(anomaly_items() - set(COLUMN_MAP))
+# Worldscope file types written at full scale; the later steps do not read the
+# others, so they are written small: a few items for the last fiscal year of a
+# sample of companies.
+WS_MAIN_FILES = ("WSFV", "WSCalendarPrd", "WSReportedPrd")
+WS_OTHER_COMPANIES = 100
+WS_OTHER_ITEMS = [8001, 8002]
+
+_ALPHABET = "0123456789ABCDEFGHJKLMNPQRSTUVWXYZ"
+
+
+def _code(number, length):
+    chars = []
+    for _ in range(length):
+        number, rest = divmod(number, len(_ALPHABET))
+        chars.append(_ALPHABET[rest])
+    return "".join(reversed(chars))
+
+
+def _ws_line(file_type, fields, **more):
+    """One line of a Worldscope file: the values of `fields` and `more` in the columns of `file_type`."""
+    fields = dict(fields, **more)
+    return "|".join(str(fields[column]) for column in WS_FILE_COLUMNS[file_type]) + "\n"
+
+
+def _format_value(value):
+    return "" if np.isnan(value) else f"{value:.4f}".rstrip("0").rstrip(".")
+
+
+class SyntheticDataGenerator:
+    def __init__(self, securities=1000, days=750, countries=5, items=40, years=10,
+                 securities_per_file=5000, start_date=date(2015, 1, 1), seed=0, nested=False):
+        if not 1 <= countries <= len(COUNTRIES):
+            raise ValueError(f"countries must be between 1 and {len(COUNTRIES)}")
+        self.securities = securities
+        self.days = days
+        self.countries = COUNTRIES[:countries]
+        fillers = (code for code in itertools.count(3000) if code not in ANOMALY_ITEMS)
+        self.items = ANOMALY_ITEMS + list(itertools.islice(fillers, max(0, items - len(ANOMALY_ITEMS))))
+        self.years = years
+        self.securities_per_file = securities_per_file
+        self.seed = seed
+        self.nested = nested
+        self.rng = np.random.default_rng(seed)
+
+        self.dates = self._trading_days(start_date, days)
+        self.last_year = self.dates[-1].year
+        self.universe = self._universe()
+        self.stats = {"ds_cells": 0, "ws_rows": 0, "matching_rows": 0}
+
+    @staticmethod
+    def _trading_days(start, count):
+        days, current = [], start
+        while len(days) < count:
+            if current.weekday() < 5:
+                days.append(current)
+            current += timedelta(days=1)
+        return days
+
+    def _universe(self):
+        """One record per security: identifiers, country and active range in trading days."""
+        country_idx = self.rng.integers(0, len(self.countries), self.securities)
+        start = np.where(self.rng.random(self.securities) < 0.7, 0,
+                         self.rng.integers(0, self.days, self.securities))
+        end = np.where(self.rng.random(self.securities) < 0.8, self.days,
+                       start + self.rng.integers(1, self.days + 1, self.securities))
+        universe = []
+        for i in range(self.securities):
+            geogc, iso, currency = self.countries[country_idx[i]]
+            universe.append({
+                "dscd": _code(i * 7919 + 12345, 6),
+                "ws_id": f"C{iso}{_code(i, 5)}",
+                "isin": f"{geogc}{i:010d}",
+                "name": f"SYNTHETIC CO {i}",
+                "geogc": geogc,
+                "currency": currency,
+                "start": int(start[i]),
+                "end": int(min(end[i], self.days)),
+            })
+        return universe
+
+    # ------------------------------------------------------------------
+    # Datastream
+    # ------------------------------------------------------------------
+    def _ds_values(self, records, kind):
+        """Return index (RI) or market value (MV) paths, NaN outside each security's active range."""
+        n = len(records)
+        if kind == "MV":
+            level = np.exp(self.rng.normal(4, 2, (n, 1)))
+        else:
+            level = np.full((n, 1), 100.0)
+        steps = self.rng.normal(0.0002, 0.02, (n, self.days))
+        values = level * np.exp(np.cumsum(steps, axis=1))
+        columns = np.arange(self.days)
+        for row, record in enumerate(records):
+            values[row, (columns < record["start"]) | (columns >= record["end"])] = np.nan
+        return values
+
+    def _ds_csv(self, records, kind, currency):
+        values = self._ds_values(records, kind)
+        if currency != "USD":
+            values = values * self.rng.uniform(0.5, 150, (len(records), 1))
+        buffer = io.StringIO()
+        buffer.write(f"Synthetic Datastream {kind} ({currency})\n")
+        writer = csv.writer(buffer, quoting=csv.QUOTE_MINIMAL, lineterminator="\n")
+        writer.writerow(DS_META_COLUMNS + [d.strftime("%d/%m/%Y") for d in self.dates])
+        for record, row in zip(records, values):
+            writer.writerow([record["dscd"], record["name"], record["isin"], record["geogc"], currency,
+                             self.dates[record["start"]].strftime("%d/%m/%Y"), ""]
+                            + [_format_value(v) for v in row])
+        self.stats["ds_cells"] += values.size
+        return buffer.getvalue().encode("us-ascii")
+
+    def datastream_files(self):
+        """Yields (member path, bytes) for every Datastream CSV."""
+        for geogc, _, currency in self.countries:
+            records = [r for r in self.universe if r["geogc"] == geogc]
+            for part, first in enumerate(range(0, len(records), self.securities_per_file), start=1):
+                chunk = records[first:first + self.securities_per_file]
+                for folder, stem in DS_FOLDERS.items():
+                    if "Index" in folder:
+                        continue
+                    kind = "MV" if "MV" in folder else "RI"
+                    file_currency = "USD" if "USD" in folder else currency
+                    yield f"{folder}/{stem}_{geogc}_{part}.csv", self._ds_csv(chunk, kind, file_currency)
+
+        # Index files are skipped by step 02 but are part of the delivery
+        for folder, stem in DS_FOLDERS.items():
+            if "Index" in folder:
+                index = [{"dscd": f"TOT{g}", "name": f"TOTAL MARKET {g}", "isin": "", "geogc": g,
+                          "start": 0, "end": self.days} for g, _, _ in self.countries]
+                yield f"{folder}/{stem}_1.csv", self._ds_csv(index, "RI", "USD" if "USD" in folder else "LC")
+
+    # ------------------------------------------------------------------
+    # Worldscope
+    # ------------------------------------------------------------------
+    def _report_dates(self, fiscal_year):
+        """Point dates at which a fiscal year is first reported and possibly restated."""
+        first = date(fiscal_year, 12, 31) + timedelta(days=int(self.rng.integers(40, 200)))
+        dates = [first]
+        if self.rng.random() < 0.2:
+            dates.append(first + timedelta(days=int(self.rng.integers(200, 900))))
+        return dates
+
+    def worldscope_files(self):
+        """Yields (member path, bytes) for every Worldscope file type."""
+        fv, calendar, reported = io.StringIO(), io.StringIO(), io.StringIO()
+        n_items = len(self.items)
+        first_year = self.last_year - self.years + 1
+        for record in self.universe:
+            ws_id = record["ws_id"]
+            base = np.exp(self.rng.normal(5, 2, n_items))
+            for fiscal_year in range(first_year, self.last_year + 1):
+                for point in self._report_dates(fiscal_year):
+                    point_date = point.strftime("%Y%m%d")
+                    values = base * self.rng.lognormal(0, 0.1, n_items)
+                    reported_items = self.rng.random(n_items) < 0.9
+                    fields = {"ws_id": ws_id, "point_date": point_date, "freq": "A", "fiscal_period": fiscal_year}
+                    for item, value, present in zip(self.items, values, reported_items):
+                        if present:
+                            fv.write(_ws_line("WSFV", fields, item_code=item, value=f"{value:.5f}"))
+                            self.stats["ws_rows"] += 1
+                    fye = f"d{fiscal_year}1231"
+                    for item, value in ((55350, fye), (55352, fye), (55555, f"s{fiscal_year}"), (57034, "s12")):
+                        calendar.write(_ws_line("WSCalendarPrd", fields, item_code=item, value=value))
+                    # A few stale records report an older period, a few have no period at all
+                    latest = fiscal_year if self.rng.random() < 0.95 else fiscal_year - 1
+                    if self.rng.random() < 0.02:
+                        latest = 0
+                    period = f"s{latest}" if latest else "0"
+                    reported.write(_ws_line("WSReportedPrd", fields, item_code=55558, value=period))
+                    reported.write(_ws_line("WSReportedPrd", fields, item_code=55559, value=period))
+                    self.stats["ws_rows"] += 6
+
+        for name, buffer in zip(WS_MAIN_FILES, (fv, calendar, reported)):
+            yield f"{name}_f_{WS_VINTAGE}.txt", buffer.getvalue().encode("windows-1252")
+        yield from self._other_worldscope_files()
+
+    def _other_worldscope_files(self):
+        """Yields (member path, bytes) for the file types besides WS_MAIN_FILES."""
+        companies = self.universe[:WS_OTHER_COMPANIES]
+        point_date = date(self.last_year, 12, 31).strftime("%Y%m%d")
+        for name in WS_FILE_COLUMNS:
+            if name in WS_MAIN_FILES:
+                continue
+            buffer = io.StringIO()
+            for record in companies:
+                for item in WS_OTHER_ITEMS:
+                    fields = {
+                        "ws_id": record["ws_id"], "point_date": point_date, "freq": "A",
+                        "fiscal_period": self.last_year, "index_name": f"WORLDSCOPE {record['geogc']}",
+                        "segment_type": "P", "segment_id": 1, "note": f"Synthetic note on item {item}",
+                    }
+                    buffer.write(_ws_line(name, fields, item_code=item, value=f"{self.rng.lognormal(5, 2):.5f}"))
+                    self.stats["ws_rows"] += 1
+            yield f"{name}_f_{WS_VINTAGE}.txt", buffer.getvalue().encode("windows-1252")
+
+    # ------------------------------------------------------------------
+    # Matching
+    # ------------------------------------------------------------------
+    def matching_files(self):
+        """Yields (member path, bytes) for the universal matching CSVs, one per country."""
+        for geogc, _, currency in self.countries:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator="\n")
+            writer.writerow(MATCHING_COLUMNS)
+            for record in self.universe:
+                if record["geogc"] != geogc:
+                    continue
+                linked = self.rng.random() < 0.9
+                writer.writerow([
+                    record["dscd"], f"F{geogc}ALL", record["dscd"], record["name"], record["isin"],
+                    f"{geogc}:{record['dscd']}", geogc, record["ws_id"] if linked else "",
+                    self.dates[record["start"]].strftime("%d/%m/%Y"), currency, currency, currency[:2],
+                ])
+                self.stats["matching_rows"] += 1
+            yield f"UniversalMatching_{geogc}.csv", buffer.getvalue().encode("windows-1252")
+
+    # ------------------------------------------------------------------
+    def write_zip(self, zip_path):
+        """
+        Write the archive. With `nested=True` every Datastream folder and the
+        Worldscope folder are stored as nested zips, like in the real delivery.
+        """
+        zip_path = Path(zip_path)
+        zip_path.parent.mkdir(parents=True, exist_ok=True)
+        groups = [
+            (f"{PREFIX}/Datastream", "Datastream", self.datastream_files()),
+            (f"{PREFIX}/Datastream/Universal Matching File", None, self.matching_files()),
+            (f"{PREFIX}/Worldscope", "Worldscope", self.worldscope_files()),
+        ]
+        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+            for folder, nested_name, files in groups:
+                if not (self.nested and nested_name):
+                    for name, data in files:
+                        archive.writestr(f"{folder}/{name}", data)
+                    continue
+                nested = io.BytesIO()
+                with zipfile.ZipFile(nested, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as inner:
+                    for name, data in files:
+                        inner.writestr(name, data)
+                archive.writestr(f"{folder}/{nested_name}.zip", nested.getvalue(), zipfile.ZIP_STORED)
+
+        logger.info(
+            f"Wrote {zip_path} ({zip_path.stat().st_size / 1024**2:.1f} MB): {self.securities} securities, "
+            f"{self.days} days, {len(self.countries)} countries, {len(self.items)} items, "
+            f"{self.stats['ds_cells']:,} Datastream cells, {self.stats['ws_rows']:,} Worldscope rows"
+        )
+        return dict(self.stats, zip_bytes=zip_path.stat().st_size)
+
+    def config(self):
+        return {
+            "securities": self.securities, "days": self.days, "countries": len(self.countries),
+            "items": len(self.items), "years": self.years, "securities_per_file": self.securities_per_file,
+            "seed": self.seed, "nested": self.nested,
+        }
+
+
+def add_arguments(parser):
+    parser.add_argument("--securities", type=int, default=1000, help="Number of securities")
+    parser.add_argument("--days", type=int, default=750, help="Number of trading days per Datastream file")
+    parser.add_argument("--countries", type=int, default=5, help=f"Number of countries (max {len(COUNTRIES)})")
+    parser.add_argument("--items", type=int, default=40, help="Number of Worldscope item codes")
+    parser.add_argument("--years", type=int, default=10, help="Number of fiscal years per company")
+    parser.add_argument("--securities-per-file", type=int, default=5000,
+                        help="Securities per Datastream CSV; larger countries are split into several files")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--nested", action="store_true", help="Store the data folders as nested zips")
+
+
+def generator_from_args(args):
+    return SyntheticDataGenerator(
+        securities=args.securities, days=args.days, countries=args.countries, items=args.items,
+        years=args.years, securities_per_file=args.securities_per_file, seed=args.seed, nested=args.nested,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Anomaly Publication.zip")
+    add_arguments(parser)
+    parser.add_argument("--output", type=Path, default=ROOT_DIR / "data" / "raw" / "Anomaly Publication.zip",
+                        help="Path of the zip to write")
+    parser.add_argument("--overwrite", action="store_true", help="Replace an existing zip at --output")
+    args = parser.parse_args()
+    if args.output.exists() and not args.overwrite:
+        parser.error(f"{args.output} exists; pass --overwrite to replace it")
+    generator_from_args(args).write_zip(args.output)
+
+
+if __name__ == "__main__":
+    main()
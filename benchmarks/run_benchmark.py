@@ -0,0 +1,164 @@
+"""
+End-to-end benchmark on synthetic data.
+
+Copies the pipeline into a scratch workspace, generates an `Anomaly
+Publication.zip` of the requested scale there (see generate_data.py), runs
+`run_pipeline.py --profile --force` on it and turns the run report into
+per-step throughput figures (rows/s, MB/s). The result is written to
+benchmarks/results/<timestamp>.json so runs before and after a change can be
+compared.
+
+Arguments after `--` are passed on to run_pipeline.py, e.g.
+
+    python benchmarks/run_benchmark.py --securities 20000 --days 2500 -- --steps 1 2 3 4 5 6 7
+"""
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from loguru import logger
+
+from generate_data import ROOT_DIR, add_arguments, generator_from_args
+
+RESULTS_DIR = ROOT_DIR / "benchmarks" / "results"
+WORKSPACE_ITEMS = ["pipeline", "scripts", "run_pipeline.py"]
+
+
+def prepare_workspace(workspace):
+    """Copy the pipeline code (not the data) into `workspace`."""
+    for item in WORKSPACE_ITEMS:
+        source = ROOT_DIR / item
+        if source.is_dir():
+            shutil.copytree(source, workspace / item, ignore=shutil.ignore_patterns("__pycache__"))
+        else:
+            shutil.copy2(source, workspace / item)
+
+
+def latest_report(workspace):
+    reports = sorted((workspace / "logs").glob("pipeline_*_report.json"))
+    if not reports:
+        return None
+    with open(reports[-1]) as f:
+        return json.load(f)
+
+
+def _per_second(amount, seconds):
+    if amount is None or not seconds:
+        return None
+    return amount / seconds
+
+
+def throughput(report):
+    """Per-step throughput from a run report."""
+    steps = []
+    for entry in report["steps"]:
+        if entry["status"] == "skipped":
+            continue
+        seconds = entry["wall_seconds"]
+        steps.append({
+            "step": entry["step"],
+            "name": entry["name"],
+            "status": entry["status"],
+            "wall_seconds": seconds,
+            "cpu_seconds": entry["cpu_seconds"],
+            "peak_rss_bytes": entry["peak_rss_bytes"],
+            "rows_in": entry["rows_in"],
+            "rows_out": entry["rows_out"],
+            "rows_in_per_second": _per_second(entry["rows_in"], seconds),
+            "rows_out_per_second": _per_second(entry["rows_out"], seconds),
+            "input_mb_per_second": _per_second(entry["input_bytes"] / 1024**2, seconds),
+            "output_mb_per_second": _per_second(entry["output_bytes"] / 1024**2, seconds),
+        })
+    return steps
+
+
+def log_summary(steps, total_seconds):
+    logger.info(f"{'step':>4}  {'wall s':>8}  {'CPU s':>8}  {'peak RSS':>9}  {'rows in/s':>11}  {'MB in/s':>8}  status")
+    for s in steps:
+        rows = f"{s['rows_in_per_second']:,.0f}" if s["rows_in_per_second"] is not None else "-"
+        mb = f"{s['input_mb_per_second']:.1f}" if s["input_mb_per_second"] is not None else "-"
+        logger.info(
+            f"{s['step']:>4}  {s['wall_seconds']:>8.1f}  {s['cpu_seconds']:>8.1f}  "
+            f"{s['peak_rss_bytes'] / 1024**3:>7.2f}GB  {rows:>11}  {mb:>8}  {s['status']}"
+        )
+    logger.info(f"Total: {total_seconds:.1f} seconds")
+
+
+def main():
+    argv = sys.argv[1:]
+    pipeline_args = []
+    if "--" in argv:
+        split = argv.index("--")
+        argv, pipeline_args = argv[:split], argv[split + 1:]
+
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic data")
+    add_arguments(parser)
+    parser.add_argument("--workspace", type=Path, default=None,
+                        help="Directory to run in (default: a temporary directory that is removed afterwards)")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary workspace")
+    parser.add_argument("--label", default=None, help="Name stored with the result, e.g. the branch or change tested")
+    args = parser.parse_args(argv)
+
+    workspace = args.workspace or Path(tempfile.mkdtemp(prefix="anomalies_benchmark_"))
+    workspace.mkdir(parents=True, exist_ok=True)
+    if any(workspace.iterdir()):
+        parser.error(f"Workspace {workspace} is not empty")
+    logger.info(f"Benchmark workspace: {workspace}")
+
+    keep = args.keep
+    try:
+        prepare_workspace(workspace)
+        generator = generator_from_args(args)
+        start_time = time.time()
+        data_stats = generator.write_zip(workspace / "data" / "raw" / "Anomaly Publication.zip")
+        generate_seconds = time.time() - start_time
+
+        command = [sys.executable, "run_pipeline.py", "--profile", "--force"] + pipeline_args
+        logger.info(f"Running: {' '.join(command)}")
+        start_time = time.time()
+        returncode = subprocess.run(command, cwd=workspace).returncode
+        total_seconds = time.time() - start_time
+
+        report = latest_report(workspace)
+        if report is None:
+            logger.error("The pipeline did not write a run report")
+            return 1
+        steps = throughput(report)
+        log_summary(steps, total_seconds)
+
+        result = {
+            "label": args.label,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "returncode": returncode,
+            "pipeline_args": pipeline_args,
+            "data": {**generator.config(), **data_stats, "generate_seconds": generate_seconds},
+            "host": report["host"],
+            "budget": report["budget"],
+            "total_seconds": total_seconds,
+            "steps": steps,
+        }
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        result_file = RESULTS_DIR / f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        with open(result_file, "w") as f:
+            json.dump(result, f, indent=1)
+        logger.info(f"Benchmark result written to {result_file}")
+        if returncode != 0:
+            keep = True
+            logger.error(f"Pipeline exited with code {returncode}, see the step logs in {workspace / 'logs'}")
+        return returncode
+
+    finally:
+        if args.workspace is None and not keep:
+            shutil.rmtree(workspace, ignore_errors=True)
+        else:
+            logger.info(f"Workspace kept at {workspace}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
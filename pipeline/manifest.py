@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+from pipeline.steps import ROOT_DIR, nested_outputs, step_settings
+
+MANIFEST_PATH = ROOT_DIR / "data" / "pipeline_manifest.json"
+SCRIPTS_DIR = ROOT_DIR / "scripts"
+
+
+def _overlaps(path, others):
+    path = Path(path)
+    return any(path == Path(o) or Path(o) in path.parents for o in others)
+
+
+def file_hash(path, block_size=8 * 1024 * 1024):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def list_files(paths, exclude=()):
+    """Expand files/folders (relative to the project root) into relative file paths."""
+    files = []
+    for rel in paths:
+        path = ROOT_DIR / rel
+        if path.is_file():
+            candidates = [path]
+        elif path.is_dir():
+            candidates = [p for p in path.rglob("*") if p.is_file()]
+        else:
+            continue
+        for p in candidates:
+            rel_path = p.relative_to(ROOT_DIR).as_posix()
+            if not _overlaps(rel_path, exclude):
+                files.append(rel_path)
+    return sorted(set(files))
+
+
+def code_version(step):
+    """
+    Hash of the step script plus the shared helper modules in scripts/ (every
+    module whose name does not start with a step number).
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    helpers = sorted(p for p in SCRIPTS_DIR.glob("*.py") if not p.name[0].isdigit())
+    for path in [ROOT_DIR / step.script] + helpers:
+        if path.exists():
+            digest.update(path.name.encode())
+            digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+class ArtifactManifest:
+    """
+    Records, per step, the fingerprints of its input files, the code version, the
+    values of the options it depends on (`step_settings`) and the fingerprints
+    of the outputs it produced. A step is up to date when all of them still match, so a changed input re-runs the step and, because the
+    re-run rewrites its outputs, every step downstream of it as well.
+
+    Fingerprints are size + mtime. With `hash_files=True` a content hash is
+    stored as well, and a file whose mtime changed but whose content did not is
+    treated as unchanged.
+    """
+
+    def __init__(self, path=MANIFEST_PATH, hash_files=False):
+        self.path = Path(path)
+        self.hash_files = hash_files
+        self._lock = threading.Lock()
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def _fingerprint(self, rel_path, previous=None):
+        stat = (ROOT_DIR / rel_path).stat()
+        fingerprint = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        if self.hash_files:
+            if previous and previous.get("hash") and previous["size"] == stat.st_size and previous["mtime_ns"] == stat.st_mtime_ns:
+                fingerprint["hash"] = previous["hash"]
+            else:
+                fingerprint["hash"] = file_hash(ROOT_DIR / rel_path)
+        return fingerprint
+
+    def _matches(self, rel_path, recorded):
+        path = ROOT_DIR / rel_path
+        if not path.is_file():
+            return False
+        stat = path.stat()
+        if stat.st_size != recorded["size"]:
+            return False
+        if stat.st_mtime_ns == recorded["mtime_ns"]:
+            return True
+        return self.hash_files and recorded.get("hash") == file_hash(path)
+
+    def _fingerprints(self, files, previous=None):
+        previous = previous or {}
+        return {f: self._fingerprint(f, previous.get(f)) for f in files}
+
+    def check(self, step):
+        """Returns (up_to_date, reason)."""
+        entry = self.entries.get(step.script)
+        if entry is None:
+            return False, "no previous run recorded"
+        if entry["code_version"] != code_version(step):
+            return False, "code changed"
+        if entry.get("settings") != step_settings(step):
+            return False, "options changed"
+
+        inputs = list_files(step.inputs, exclude=step.outputs)
+        if set(inputs) != set(entry["inputs"]):
+            return False, "input files added or removed"
+        for rel_path in inputs:
+            if not self._matches(rel_path, entry["inputs"][rel_path]):
+                return False, f"input changed: {rel_path}"
+
+        if not entry["outputs"]:
+            return False, "no outputs recorded"
+        for rel_path, recorded in entry["outputs"].items():
+            if not self._matches(rel_path, recorded):
+                return False, f"output missing or modified: {rel_path}"
+        return True, None
+
+    def record(self, step):
+        previous = self.entries.get(step.script, {})
+        entry = {
+            "code_version": code_version(step),
+            "settings": step_settings(step),
+            "inputs": self._fingerprints(list_files(step.inputs, exclude=step.outputs), previous.get("inputs")),
+            "outputs": self._fingerprints(list_files(step.outputs, exclude=nested_outputs(step)), previous.get("outputs")),
+        }
+        with self._lock:
+            self.entries[step.script] = entry
+            self.save()
+
+    def invalidate(self, step):
+        with self._lock:
+            if self.entries.pop(step.script, None) is not None:
+                self.save()
@@ -0,0 +1,147 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import psutil
+import pyarrow.parquet as pq
+
+from pipeline.manifest import list_files
+from pipeline.steps import ROOT_DIR
+
+
+class ProcessTreeSampler(threading.Thread):
+    """
+    Polls a process and all of its descendants (e.g. the worker pools of steps 02
+    and 03) and keeps the peak summed RSS and the largest CPU time / IO counters
+    of the tree. The counters of a process include the children it has reaped,
+    so workers that exit between two samples are counted by their parent; `stop`
+    takes a last sample, which sees the whole tree if the process has exited but
+    is not reaped yet (see run_profiled).
+    """
+
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self.cpu_seconds = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._stop_event = threading.Event()
+
+    def _sample(self):
+        try:
+            root = psutil.Process(self.pid)
+            processes = [root] + root.children(recursive=True)
+        except psutil.Error:
+            return
+        rss = cpu_seconds = bytes_read = bytes_written = 0
+        for process in processes:
+            try:
+                with process.oneshot():
+                    rss += process.memory_info().rss
+                    cpu = process.cpu_times()
+                    cpu_seconds += cpu.user + cpu.system + cpu.children_user + cpu.children_system
+                    if hasattr(process, "io_counters"):
+                        io = process.io_counters()
+                        # read_chars/write_chars (Linux) also count reads served from the page cache
+                        bytes_read += getattr(io, "read_chars", io.read_bytes)
+                        bytes_written += getattr(io, "write_chars", io.write_bytes)
+            except psutil.Error:
+                continue
+        self.peak_rss = max(self.peak_rss, rss)
+        self.cpu_seconds = max(self.cpu_seconds, cpu_seconds)
+        self.bytes_read = max(self.bytes_read, bytes_read)
+        self.bytes_written = max(self.bytes_written, bytes_written)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self._sample()
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self._sample()
+
+
+def _wait_exited(process):
+    """
+    Wait until the process has exited; where available without reaping it, so
+    its counters (including the children it reaped) can still be sampled.
+    """
+    if hasattr(os, "waitid") and hasattr(os, "WNOWAIT"):
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+    else:
+        process.wait()
+
+
+def _wait(process):
+    """
+    Reap the process; where available use wait4 so the CPU time and max RSS
+    of the process and the children it reaped are exact rather than sampled.
+    """
+    if process.returncode is not None or not hasattr(os, "wait4"):
+        return process.wait(), None
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, usage
+
+
+def run_profiled(command, stdout=None, env=None, interval=0.5):
+    """Run a command and return (returncode, metrics)."""
+    start_time = time.time()
+    process = subprocess.Popen(command, cwd=ROOT_DIR, env=env, stdout=stdout, stderr=subprocess.STDOUT if stdout else None)
+    sampler = ProcessTreeSampler(process.pid, interval)
+    sampler.start()
+    try:
+        _wait_exited(process)
+    finally:
+        sampler.stop()
+    returncode, usage = _wait(process)
+
+    metrics = {
+        "wall_seconds": time.time() - start_time,
+        "cpu_seconds": sampler.cpu_seconds,
+        "peak_rss_bytes": sampler.peak_rss,
+        "bytes_read": sampler.bytes_read,
+        "bytes_written": sampler.bytes_written,
+    }
+    if usage is not None:
+        metrics["cpu_seconds"] = max(metrics["cpu_seconds"], usage.ru_utime + usage.ru_stime)
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        max_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+        metrics["peak_rss_bytes"] = max(metrics["peak_rss_bytes"], max_rss)
+    return returncode, metrics
+
+
+def artifact_stats(paths, exclude=()):
+    """
+    Number of files, total bytes and total rows of the files under `paths`.
+    Rows are read from parquet footers only; None if there is no parquet file.
+    """
+    files = list_files(paths, exclude=exclude)
+    total_bytes, rows = 0, None
+    for rel_path in files:
+        path = ROOT_DIR / rel_path
+        total_bytes += path.stat().st_size
+        if path.suffix == ".parquet":
+            try:
+                rows = (rows or 0) + pq.ParquetFile(path).metadata.num_rows
+            except Exception:
+                pass
+    return {"files": len(files), "bytes": total_bytes, "rows": rows}
+
+
+def pyinstrument_command(script, renderer, output_file):
+    """Command that runs `script` under pyinstrument (main process only)."""
+    return [sys.executable, "-m", "pyinstrument", "-r", renderer, "-o", str(output_file), script]
+
+
+def format_bytes(size):
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if size < 1024 or unit == "TB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
@@ -0,0 +1,253 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import psutil
+from loguru import logger
+
+from pipeline.profiling import artifact_stats, format_bytes, pyinstrument_command, run_profiled
+from pipeline.steps import ROOT_DIR, nested_outputs
+
+
+def _paths_overlap(a, b):
+    """True if one path is the other or lies inside it."""
+    a, b = Path(a), Path(b)
+    return a == b or a in b.parents or b in a.parents
+
+
+def build_dependencies(steps):
+    """
+    Derive the step graph from declared inputs/outputs.
+
+    Step j depends on an earlier step i if one of j's inputs overlaps one of i's
+    outputs. Only earlier steps are considered, so the list order of
+    `PIPELINE_STEPS` breaks ties and the graph can never contain a cycle.
+    Returns {step_number: set(step_numbers)} with 1-based step numbers.
+    """
+    deps = {}
+    for j, step in enumerate(steps, start=1):
+        deps[j] = {
+            i for i, upstream in enumerate(steps[:j - 1], start=1)
+            if any(_paths_overlap(inp, out) for inp in step.inputs for out in upstream.outputs)
+        }
+    return deps
+
+
+def restrict_dependencies(deps, selected):
+    """
+    Project the graph onto the selected steps. A selected step waits for every
+    selected ancestor, also when the link runs through steps that are not selected.
+    """
+    selected = set(selected)
+    restricted = {}
+    for number in selected:
+        ancestors, stack = set(), list(deps[number])
+        while stack:
+            parent = stack.pop()
+            if parent not in ancestors:
+                ancestors.add(parent)
+                stack.extend(deps[parent])
+        restricted[number] = ancestors & selected
+    return restricted
+
+
+class StepScheduler:
+    """
+    Runs pipeline steps as separate processes as soon as their upstream steps
+    have finished, as long as the summed `cpus`/`memory_gb` of the running steps
+    stays within the global budget. A step that is larger than the whole budget
+    still runs, but only when nothing else is running.
+    """
+
+    def __init__(self, steps, max_cpus=None, max_memory_gb=None, log_prefix=None, manifest=None, force=False,
+                 profile=False, pyinstrument=None):
+        self.steps = steps
+        self.manifest = manifest
+        self.force = force
+        self.profile = profile
+        self.pyinstrument = pyinstrument
+        self.report = {}
+        self.max_cpus = max_cpus or os.cpu_count()
+        self.max_memory_gb = max_memory_gb or psutil.virtual_memory().available / (1024**3)
+        self.log_prefix = log_prefix
+        self.dependencies = build_dependencies(steps)
+
+    def _fits(self, step, running):
+        if not running:
+            return True
+        cpus = sum(self.steps[i - 1].cpus for i in running)
+        memory = sum(self.steps[i - 1].memory_gb for i in running)
+        return (cpus + step.cpus <= self.max_cpus
+                and memory + step.memory_gb <= self.max_memory_gb)
+
+    def _step_log(self, number):
+        if self.log_prefix is None:
+            return None
+        return Path(f"{self.log_prefix}_step{number:02d}.log")
+
+    def _command(self, number):
+        step = self.steps[number - 1]
+        if self.pyinstrument and self.log_prefix is not None:
+            output_file = Path(f"{self.log_prefix}_step{number:02d}.{self.pyinstrument}")
+            return pyinstrument_command(step.script, self.pyinstrument, output_file)
+        return [sys.executable, step.script]
+
+    def _environment(self, step):
+        """
+        Environment of a step process: its CPU and memory budget for the scripts
+        (see scripts/resources.py) and the matching Polars/Rayon thread pool size.
+        """
+        processes = max(1, min(step.processes, step.cpus))
+        threads_per_process = str(max(1, step.cpus // processes))
+        return {
+            **os.environ,
+            "PIPELINE_THREADS": str(step.cpus),
+            "PIPELINE_PROCESSES": str(processes),
+            "PIPELINE_MEMORY_GB": str(step.memory_gb),
+            "POLARS_MAX_THREADS": threads_per_process,
+            "RAYON_NUM_THREADS": threads_per_process,
+        }
+
+    def run_step(self, number):
+        """Run one step script in its own interpreter. Returns (returncode, elapsed)."""
+        step = self.steps[number - 1]
+        log_file = self._step_log(number)
+        command = self._command(number)
+        env = self._environment(step)
+        start_time = time.time()
+
+        out = open(log_file, "w") if log_file is not None else None
+        try:
+            if self.profile:
+                inputs = artifact_stats(step.inputs, exclude=step.outputs)
+                returncode, metrics = run_profiled(command, stdout=out, env=env)
+                outputs = artifact_stats(step.outputs, exclude=nested_outputs(step, self.steps))
+                self.report[number] = {
+                    "step": number, "name": step.name, "script": step.script,
+                    "status": "done" if returncode == 0 else "failed",
+                    **metrics,
+                    "rows_in": inputs["rows"], "rows_out": outputs["rows"],
+                    "input_files": inputs["files"], "input_bytes": inputs["bytes"],
+                    "output_files": outputs["files"], "output_bytes": outputs["bytes"],
+                }
+            else:
+                returncode = subprocess.run(command, cwd=ROOT_DIR, env=env, stdout=out,
+                                            stderr=subprocess.STDOUT if out else None).returncode
+        finally:
+            if out is not None:
+                out.close()
+
+        return returncode, time.time() - start_time
+
+    def execute(self, number):
+        """
+        Run a step unless the manifest shows its inputs, code and outputs are
+        unchanged since its last successful run. Returns (status, returncode, elapsed)
+        with status "skipped", "done" or "failed".
+        """
+        step = self.steps[number - 1]
+        if self.manifest is not None and not self.force:
+            up_to_date, reason = self.manifest.check(step)
+            if up_to_date:
+                if self.profile:
+                    self.report[number] = {"step": number, "name": step.name, "script": step.script, "status": "skipped"}
+                return "skipped", 0, 0.0
+            logger.info(f"Step {number} needs to run: {reason}")
+
+        logger.info(f"Starting step: {step.name} ({number}) with {step.cpus} CPUs")
+        returncode, elapsed = self.run_step(number)
+        if self.manifest is not None:
+            if returncode == 0:
+                self.manifest.record(step)
+            else:
+                self.manifest.invalidate(step)
+        return ("done" if returncode == 0 else "failed"), returncode, elapsed
+
+    def _log_failure(self, number):
+        log_file = self._step_log(number)
+        if log_file is None or not log_file.exists():
+            return
+        tail = log_file.read_text(errors="replace").splitlines()[-20:]
+        logger.error(f"Last lines of {log_file}:\n" + "\n".join(tail))
+
+    def run(self, selected):
+        selected = [n for n in selected if 1 <= n <= len(self.steps)]
+        missing = [n for n in selected if not (ROOT_DIR / self.steps[n - 1].script).exists()]
+        for number in missing:
+            logger.warning(f"Step {number} script {self.steps[number - 1].script} not found. Skipping.")
+        selected = [n for n in selected if n not in missing]
+
+        waiting_on = restrict_dependencies(self.dependencies, selected)
+        pending = sorted(selected)
+        done, running, failed = set(), {}, []
+
+        logger.info(
+            f"Scheduling {len(pending)} steps with a budget of "
+            f"{self.max_cpus} CPUs and {self.max_memory_gb:.1f}GB memory"
+        )
+
+        with ThreadPoolExecutor(max_workers=max(len(pending), 1)) as executor:
+            while pending or running:
+                if not failed:
+                    for number in list(pending):
+                        step = self.steps[number - 1]
+                        if waiting_on[number] <= done and self._fits(step, running):
+                            pending.remove(number)
+                            running[number] = executor.submit(self.execute, number)
+                elif not running:
+                    break
+
+                finished, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+                for number in [n for n, f in running.items() if f in finished]:
+                    step = self.steps[number - 1]
+                    status, returncode, elapsed = running.pop(number).result()
+                    if status == "skipped":
+                        done.add(number)
+                        logger.info(f"Skipped step: {step.name} ({number}), inputs unchanged since last run")
+                    elif status == "done":
+                        done.add(number)
+                        logger.success(f"Completed step: {step.name} ({number}) in {elapsed:.2f} seconds")
+                    else:
+                        failed.append(number)
+                        logger.error(f"Step {step.name} ({number}) failed with exit code {returncode}")
+                        self._log_failure(number)
+
+        if failed:
+            skipped = sorted(pending)
+            if skipped:
+                logger.warning(f"Not started because of failures: {skipped}")
+            raise RuntimeError(f"Steps failed: {failed}")
+
+    def write_report(self, path, total_seconds):
+        """Write the collected per-step metrics as one JSON document and log a summary."""
+        report = {
+            "started": self.log_prefix.name if self.log_prefix is not None else None,
+            "total_seconds": total_seconds,
+            "host": {
+                "platform": platform.platform(),
+                "python": platform.python_version(),
+                "cpus": os.cpu_count(),
+                "memory_bytes": psutil.virtual_memory().total,
+            },
+            "budget": {"max_cpus": self.max_cpus, "max_memory_gb": self.max_memory_gb},
+            "steps": [self.report[n] for n in sorted(self.report)],
+        }
+        with open(path, "w") as f:
+            json.dump(report, f, indent=1)
+
+        for entry in report["steps"]:
+            if entry["status"] == "skipped":
+                logger.info(f"Step {entry['step']:>2}: skipped")
+                continue
+            logger.info(
+                f"Step {entry['step']:>2}: {entry['wall_seconds']:8.1f}s wall, {entry['cpu_seconds']:8.1f}s CPU, "
+                f"peak RSS {format_bytes(entry['peak_rss_bytes'])}, "
+                f"read {format_bytes(entry['bytes_read'])}, written {format_bytes(entry['bytes_written'])}, "
+                f"rows {entry['rows_in']} -> {entry['rows_out']}"
+            )
+        logger.info(f"Run report written to {path}")
@@ -0,0 +1,171 @@
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+
+RAW_DIR = "data/raw"
+RAW_ZIP = f"{RAW_DIR}/Anomaly Publication.zip"
+PUBLICATION_DIR = f"{RAW_DIR}/Anomaly Publication"
+DS_RAW_DIR = f"{PUBLICATION_DIR}/Data/Datastream"
+WS_RAW_DIR = f"{PUBLICATION_DIR}/Data/Worldscope"
+MATCHING_RAW_DIR = f"{DS_RAW_DIR}/Universal Matching File"
+
+DS_INTERIM_DIR = "data/interim/datastream"
+WS_INTERIM_DIR = "data/interim/worldscope"
+MATCHING_INTERIM_DIR = "data/interim/universal matching file"
+WS_CLEAN_DIR = "data/interim/Worldscope_clean"
+SECURITY_MASTER_DIR = "data/interim/security_master"
+WS_ITEMS_DIR = "data/interim/Worldscope_clean_items"
+
+# Options of run_pipeline.py that change what a step writes, passed as environment variables
+RAW_SOURCE = "PIPELINE_RAW_SOURCE"
+WS_INGEST = "PIPELINE_WS_INGEST"
+WS_BLOOM_FILTERS = "PIPELINE_WS_BLOOM_FILTERS"
+OUT_OF_CORE = "PIPELINE_OUT_OF_CORE"
+
+
+@dataclass(frozen=True)
+class Step:
+    """
+    One pipeline step. `inputs` and `outputs` are paths relative to the project
+    root (files or folders); the scheduler derives the dependency graph from them.
+    `cpus` and `memory_gb` are the step's share of the global resource budget,
+    used to decide which steps may start together (memory is not enforced);
+    `cpus` is also the number of threads the step may use. Steps with a worker
+    pool split them over `processes` processes. Steps that can run out of core
+    (streaming, see scripts/out_of_core.py) declare the memory they need in that
+    mode as `out_of_core_memory_gb`. `settings` are the option variables (see
+    above) the step's outputs depend on; the manifest re-runs the step when one
+    of them changes.
+    """
+    name: str
+    script: str
+    inputs: tuple = field(default_factory=tuple)
+    outputs: tuple = field(default_factory=tuple)
+    cpus: int = 1
+    memory_gb: float = 4.0
+    processes: int = 1
+    out_of_core_memory_gb: float = None
+    settings: tuple = field(default_factory=tuple)
+
+
+PIPELINE_STEPS = [
+
+#Extraction process and DS setup
+    Step("Extract data", "scripts/01_extract_data.py",
+         inputs=(RAW_ZIP,),
+         outputs=(PUBLICATION_DIR,),
+         cpus=4, memory_gb=2),
+    Step("Process Datastream data", "scripts/02_process_ds.py",
+         inputs=tuple(f"{DS_RAW_DIR}/{folder}" for folder in (
+             "Daily Index Returns LC", "Daily Index Returns USD",
+             "Daily MV LC", "Daily MV USD",
+             "Daily Returns LC", "Daily Returns USD")) + (RAW_ZIP,),
+         outputs=(DS_INTERIM_DIR,),
+         cpus=8, memory_gb=16, processes=8, settings=(RAW_SOURCE,)),
+    Step("Process Worldscope data", "scripts/03_process_ws.py",
+         # The anomaly definitions decide which items are ingested (scripts/ws_ingestion.py)
+         inputs=(WS_RAW_DIR, RAW_ZIP, "scripts/anomaly_config.py"),
+         outputs=(WS_INTERIM_DIR,),
+         cpus=8, memory_gb=8, settings=(RAW_SOURCE, WS_INGEST, WS_BLOOM_FILTERS)),
+    Step("Process matching files", "scripts/04_process_matching_files.py",
+         inputs=(MATCHING_RAW_DIR, RAW_ZIP),
+         outputs=(f"{MATCHING_INTERIM_DIR}/UniverseMatchingFile_consolidated.parquet",
+                  f"{MATCHING_INTERIM_DIR}/UniverseMatchingFile_history.parquet"),
+         # Streams the matching CSVs through Arrow itself, whether or not --out-of-core is set
+         cpus=2, memory_gb=4, settings=(RAW_SOURCE,)),
+    Step("Build security master", "scripts/05_build_security_master.py",
+         inputs=(f"{DS_INTERIM_DIR}/coverage", WS_INTERIM_DIR,
+                 f"{MATCHING_INTERIM_DIR}/UniverseMatchingFile_consolidated.parquet",
+                 f"{MATCHING_INTERIM_DIR}/UniverseMatchingFile_history.parquet"),
+         outputs=(SECURITY_MASTER_DIR,),
+         cpus=2, memory_gb=8, out_of_core_memory_gb=2),
+    Step("Merge datastream files", "scripts/06_merge_ds_files.py",
+         inputs=(DS_INTERIM_DIR,
+                 f"{SECURITY_MASTER_DIR}/ds_securities.parquet"),
+         outputs=(f"{DS_INTERIM_DIR}/Datastream_consolidated",),
+         cpus=8, memory_gb=8),
+    Step("Merge datastream and Matching", "scripts/07_merge_ds_mts.py",
+         inputs=(f"{DS_INTERIM_DIR}/Datastream_consolidated",
+                 SECURITY_MASTER_DIR),
+         outputs=("data/processed/Datastream_with_matching",),
+         cpus=4, memory_gb=64, out_of_core_memory_gb=8),
+        #Placeholder: Data clearning DS: Drop missing matching variable, no value
+#Prepare WS Data
+        #Merge WS Values with PRD Data
+    Step("Add Period info WS data", "scripts/08_merge_prd_in_WS.py",        #for FV, Ratios, Suppl. and Current
+         inputs=(f"{WS_INTERIM_DIR}/WSFV_f_20250131.parquet",
+                 f"{WS_INTERIM_DIR}/WSCalendarPrd_f_20250131.parquet",
+                 f"{WS_INTERIM_DIR}/WSReportedPrd_f_20250131.parquet",
+                 f"{SECURITY_MASTER_DIR}/ws_securities.parquet"),
+         outputs=(f"{WS_CLEAN_DIR}/WSFV_merged_20250131.parquet",),
+         cpus=4, memory_gb=64, out_of_core_memory_gb=8),
+        #Data cleaning WS: Drop: No PRD data
+    Step("Drop if missing PRD", "scripts/09_Drop_if_missing_PRD.py",
+         inputs=(f"{WS_CLEAN_DIR}/WSFV_merged_20250131.parquet",),
+         outputs=(f"{WS_CLEAN_DIR}/WSFV_merged_20250131_filtered.parquet",),
+         cpus=2, memory_gb=48, out_of_core_memory_gb=4),
+        #Drop if data is old
+    Step("Drop nonrecent data", "scripts/10_Drop_if_not_recent.py",
+         inputs=(f"{WS_CLEAN_DIR}/WSFV_merged_20250131_filtered.parquet",),
+         outputs=(f"{WS_CLEAN_DIR}/WSFV_merged_20250131_final.parquet",),
+         cpus=2, memory_gb=32, out_of_core_memory_gb=4),
+        #Drop unnessary variables, write the cleaned items partitioned by file type, freq and item code
+    Step("Drop variables, which are not needed ", "scripts/11_Drop_unnes_var.py",
+         inputs=(f"{WS_CLEAN_DIR}/WSFV_merged_20250131_final.parquet",),
+         outputs=(WS_ITEMS_DIR,),
+         cpus=2, memory_gb=32, out_of_core_memory_gb=4, settings=(WS_BLOOM_FILTERS,)),
+        #The division into items is part of the item store of step 11; the entry keeps the
+        #numbers of the later steps (--steps, --step-cpus) equal to their script numbers
+    Step("Dividing the Worldscope dataset", "scripts/12_WS_division.py"),
+        #Data clearning DS: Drop missing matching variable, no value
+
+
+
+#Quick data analysis
+    Step("Generate Table 3 Anomaly Time, PIT vs FF92", "scripts/13_Comparison_PITvsFF92.py",
+         inputs=(WS_ITEMS_DIR,),
+         outputs=("data/interim/Worldscope_clean_panels/panel_A_diff_pit_to_fye.csv",
+                  "data/interim/Worldscope_clean_panels/panel_B_diff_pit_to_ff92.csv",
+                  "data/interim/Worldscope_clean_panels/panel_C_availability_at_FF92.csv"),
+         cpus=8, memory_gb=32, out_of_core_memory_gb=4),
+    Step("Generate Table 3 Anomaly Time, subsamples", "scripts/14_Comparison_subsample.py",
+         inputs=(WS_ITEMS_DIR,),
+         outputs=("data/interim/Worldscope_clean_panels/panel_after_ff92_only.csv",
+                  "data/interim/Worldscope_clean_panels/panel_before_ff92_only.csv"),
+         cpus=8, memory_gb=32),
+
+    Step("Compute the return predictors in Worldscope", "scripts/15_compute_anomalies.py",
+         inputs=(WS_ITEMS_DIR,),
+         outputs=("data/processed/anomalies_worldscope.parquet",),
+         cpus=8, memory_gb=16),
+    Step("Building portfolios based on return predictors FF92", "scripts/16_build_portfolios_ff92.py",
+         inputs=("data/processed/anomalies_worldscope.parquet",
+                 "data/processed/Datastream_with_matching"),
+         outputs=("data/processed/portfolios_ff92",),
+         cpus=8, memory_gb=32),
+
+    Step("Add Period info WS data (script 20)", "scripts/20_merge_prd_in_WS.py"),
+]
+
+
+def step_settings(step):
+    """
+    Values of the options `step` depends on in this run: its `settings` and, for
+    steps that can run out of core, whether they do.
+    """
+    names = list(step.settings) + ([OUT_OF_CORE] if step.out_of_core_memory_gb else [])
+    return {name: os.environ.get(name) for name in names}
+
+
+def nested_outputs(step, steps=PIPELINE_STEPS):
+    """
+    Outputs of other steps that lie inside one of `step`'s output folders (e.g. the
+    partitioned dataset step 06 writes into the folder of step 02); they do not belong to `step`.
+    """
+    return [
+        out for other in steps if other is not step
+        for out in other.outputs
+        if any(Path(own) in Path(out).parents for own in step.outputs)
+    ]
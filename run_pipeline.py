@@ -2,101 +2,118 @@ import os
 import sys
 import time
 import argparse
+from dataclasses import replace
 from pathlib import Path
 from datetime import datetime
-import importlib.util
 from loguru import logger
 
+from pipeline.manifest import ArtifactManifest
+from pipeline.scheduler import StepScheduler
+from pipeline.steps import PIPELINE_STEPS
+
 log_path = Path("logs")
 log_path.mkdir(exist_ok=True)
-log_file = log_path / f"pipeline_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+log_prefix = log_path / f"pipeline_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+log_file = log_prefix.with_suffix(".log")
 
 logger.remove()  
 logger.add(sys.stderr, level="INFO")  
 logger.add(log_file, rotation="100 MB", level="DEBUG") 
 
-def import_script(script_path):
-    script_path = Path(script_path)
-    module_name = script_path.stem
-    
-    spec = importlib.util.spec_from_file_location(module_name, script_path)
-    module = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(module)
-    
-    return module
+def parse_step_values(values, option):
+    """Parse STEP=N pairs such as `--step-cpus 13=64 15=32`."""
+    parsed = {}
+    for value in values or []:
+        try:
+            number, count = value.split("=")
+            parsed[int(number)] = int(count)
+        except ValueError:
+            raise SystemExit(f"{option}: expected STEP=N, got {value!r}")
+        if not 1 <= int(number) <= len(PIPELINE_STEPS) or int(count) < 1:
+            raise SystemExit(f"{option}: invalid value {value!r}")
+    return parsed
 
-def run_step(step_name, script_path):
-    logger.info(f"Starting step: {step_name}")
-    start_time = time.time()
-    
-    module = import_script(script_path)
-    module.main()
-    
-    elapsed_time = time.time() - start_time
-    logger.success(f"Completed step: {step_name} in {elapsed_time:.2f} seconds")
+def apply_budgets(steps, cpus, processes):
+    """Copy of `steps` with the per-step CPU/process budgets overridden."""
+    steps = list(steps)
+    for number, count in cpus.items():
+        steps[number - 1] = replace(steps[number - 1], cpus=count)
+    for number, count in processes.items():
+        steps[number - 1] = replace(steps[number - 1], processes=count)
+    return steps
 
 def main():
     parser = argparse.ArgumentParser(description="Run the financial data processing pipeline")
     parser.add_argument("--steps", nargs="+", type=int, help="Specific steps to run (e.g., --steps 1 3)")
+    parser.add_argument("--max-cpus", type=int, default=os.cpu_count(),
+                        help="CPU budget shared by all steps running at the same time (1 runs steps one by one)")
+    parser.add_argument("--max-memory-gb", type=float, default=None,
+                        help="Memory budget for admitting steps: the declared memory of the steps running at the same "
+                             "time stays below it; not enforced on the step processes (default: available memory)")
+    parser.add_argument("--force", action="store_true",
+                        help="Re-run the selected steps even if their inputs have not changed")
+    parser.add_argument("--hash-inputs", action="store_true",
+                        help="Fingerprint files by content hash as well, so touched but unchanged files do not trigger re-runs")
+    parser.add_argument("--raw-source", choices=["auto", "dir", "zip"], default="auto",
+                        help="Read raw files from the extracted folder (dir) or straight from the zip archive (zip); "
+                             "with zip, step 1 is not run")
+    parser.add_argument("--changed-raw-only", action="store_true",
+                        help="Steps 2 and 3 only convert the raw files that changed since they last converted them")
+    parser.add_argument("--ws-ingest", choices=["plan", "all"], default="plan",
+                        help="Step 3 converts only the Worldscope files and items used later (plan, see "
+                             "scripts/ws_ingestion.py) or everything (all)")
+    parser.add_argument("--ws-bloom-filters", action="store_true",
+                        help="Add Bloom filters on ws_id to the Worldscope parquet files of steps 3 and 11")
+    parser.add_argument("--profile", action="store_true",
+                        help="Record wall/CPU time, peak RSS, rows and bytes per step and write a JSON run report")
+    parser.add_argument("--pyinstrument", choices=["html", "json"], default=None,
+                        help="Also save a pyinstrument profile of every step in this format")
+    parser.add_argument("--out-of-core", action="store_true",
+                        help="Run the steps that support it (5, 7-11, 13) on Polars' streaming engine; they then reserve "
+                             "only their out-of-core memory from the --max-memory-gb admission budget")
+    parser.add_argument("--step-cpus", nargs="+", metavar="STEP=N",
+                        help="Override the CPU/thread budget of single steps (e.g. --step-cpus 13=64 15=32)")
+    parser.add_argument("--step-processes", nargs="+", metavar="STEP=N",
+                        help="Override the number of worker processes of steps with a process pool (e.g. --step-processes 2=16)")
     args = parser.parse_args()
-    
-    
-    pipeline_steps = [
-
-#Extraction process and DS setup
-        ("Extract data", "scripts/01_extract_data.py"),
-        ("Process Datastream data", "scripts/02_process_ds.py"),
-        ("Process Worldscope data", "scripts/03_process_ws.py"),
-        ("Process matching files", "scripts/04_process_matching_files.py"),
-        ("Merge matching files", "scripts/05_merge_matching_files.py"),
-        ("Merge datastream files", "scripts/06_merge_ds_files.py"),
-        ("Merge datastream and Matching", "scripts/07_merge_ds_mts.py"),
-        #Placeholder: Data clearning DS: Drop missing matching variable, no value
-#Prepare WS Data
-        #Merge WS Values with PRD Data
-        ("Add Period info WS data", "scripts/08_merge_prd_in_WS.py"),        #for FV, Ratios, Suppl. and Current
-        #Data cleaning WS: Drop: No PRD data
-        ("Drop if missing PRD", "scripts/09_Drop_if_missing_PRD.py"),
-        #Drop if data is old 
-        ("Drop nonrecent data", "scripts/10_Drop_if_not_recent.py"),
-        #Drop unnessary variables
-        ("Drop variables, which are not needed ", "scripts/11_Drop_unnes_var.py"),
-        #Data clearning DS: Drop missing matching variable, no value
-
-        
-#Merge WS into DS        
-        ("Dividing the Worldscope dataset", "scripts/12_WS_division.py"), #Adjust such that date information is kept
-
-
-        
-#Quick data analysis 
-        ("Generate Table 3 Anomaly Time", "scripts/13_Comparison_PITvsFF92.py"),
-        ("Generate Table 3 Anomaly Time", "scripts/14_Comparison_subsample.py"),
-        
-        ("Compute the return predictors in Worldscope", "scripts/15_compute_anomalies.py"),
-        ("Building portfolios based on return predictors FF92", "scripts/16_build_portfolios_ff92.py"),
-        
-        ("Add Period info WS data", "scripts/20_merge_prd_in_WS.py")       
-    ]
-
-#
-
-
-
+    os.environ["PIPELINE_RAW_SOURCE"] = args.raw_source
+    os.environ["PIPELINE_WS_INGEST"] = args.ws_ingest
+    if args.ws_bloom_filters:
+        os.environ["PIPELINE_WS_BLOOM_FILTERS"] = "1"
+    if args.changed_raw_only:
+        os.environ["PIPELINE_CHANGED_RAW_ONLY"] = "1"
+    if args.out_of_core:
+        os.environ["PIPELINE_OUT_OF_CORE"] = "1"
     
     logger.info(f"Starting data pipeline with")
     
-    steps_to_run = args.steps if args.steps else range(1, len(pipeline_steps) + 1)
+    steps_to_run = args.steps if args.steps else range(1, len(PIPELINE_STEPS) + 1)
+    if args.raw_source == "zip":
+        steps_to_run = [i for i in steps_to_run if i != 1]
+    for i in steps_to_run:
+        if not 1 <= i <= len(PIPELINE_STEPS):
+            logger.warning(f"Step {i} does not exist. Skipping.")
+    
+    steps = apply_budgets(PIPELINE_STEPS,
+                          parse_step_values(args.step_cpus, "--step-cpus"),
+                          parse_step_values(args.step_processes, "--step-processes"))
+    if args.out_of_core:
+        steps = [replace(s, memory_gb=s.out_of_core_memory_gb) if s.out_of_core_memory_gb else s for s in steps]
+    scheduler = StepScheduler(
+        steps,
+        max_cpus=args.max_cpus,
+        max_memory_gb=args.max_memory_gb,
+        log_prefix=log_prefix,
+        manifest=ArtifactManifest(hash_files=args.hash_inputs),
+        force=args.force,
+        profile=args.profile,
+        pyinstrument=args.pyinstrument
+    )
     
     start_time = time.time()
     
     try:
-        for i in steps_to_run:
-            if 1 <= i <= len(pipeline_steps):
-                step_name, script_path = pipeline_steps[i-1]
-                run_step(step_name, script_path)
-            else:
-                logger.warning(f"Step {i} does not exist. Skipping.")
+        scheduler.run(steps_to_run)
     
     except Exception as e:
         logger.error(f"Pipeline failed: {str(e)}")
@@ -105,6 +122,8 @@ def main():
     finally:
         total_time = time.time() - start_time
         logger.info(f"Pipeline completed in {total_time:.2f} seconds")
+        if args.profile:
+            scheduler.write_report(log_prefix.parent / f"{log_prefix.name}_report.json", total_time)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,15 +1,21 @@
+import json
 import os
+import sys
+import time
 import zipfile
+import zlib
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 
 import psutil
 from loguru import logger
 from tqdm import tqdm
 
-ROOT_DIR = Path(__file__).resolve().parents[1]
-RAW_DATA_DIR = ROOT_DIR / "data" / "raw"
-ZIP_FILE_PATH = RAW_DATA_DIR / "Anomaly Publication.zip"
+from raw_source import EXTRACT_DELTA_PATH, EXTRACT_STATE_PATH, RAW_DATA_DIR, ROOT_DIR, ZIP_FILE_PATH
+from resources import thread_budget
+
+# Members are handed to the extraction workers in chunks of about this many bytes
+CHUNK_BYTES = 256 * 1024**2
 
 logger.remove()
 logger.add(
@@ -28,7 +34,7 @@ def ensure_directories():
         directory.mkdir(parents=True, exist_ok=True)
 
 def extract_zip_chunk(args):
-    """Used in the original code for chunked multi-thread extractions if desired."""
+    """Extract one chunk of members from an archive; the pool runs many of these in parallel."""
     zip_path, extract_dir, file_chunk = args
     extracted = 0
     try:
@@ -41,18 +47,165 @@ def extract_zip_chunk(args):
         logger.error(f"Error extracting chunk from {zip_path}: {e}")
         return extracted
 
-def extract_single_zip(nested_zip):
-    """Extract an entire ZIP file into its parent folder."""
-    try:
-        extract_dir = nested_zip.parent
-        with zipfile.ZipFile(nested_zip, 'r') as zip_ref:
-            file_count = len(zip_ref.namelist())
-            for file in zip_ref.namelist():
-                zip_ref.extract(file, extract_dir)
-        return file_count
-    except Exception as e:
-        logger.error(f"Error extracting {nested_zip}: {e}")
-        return 0
+def file_crc32(path, block_size=8 * 1024 * 1024):
+    crc = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            crc = zlib.crc32(block, crc)
+    return crc
+
+class ExtractionState:
+    """
+    CRC32 and size of every extracted file, as listed in the central directory of
+    the archive it came from. Members whose CRC and size match the file already in
+    data/raw are not written again, so a new vintage of the zip only costs the
+    members that actually changed. The added/changed/removed files of the run are
+    written to EXTRACT_DELTA_PATH as a report; steps 02 and 03 keep track of the
+    files they converted themselves (raw_source.ConvertedRawFiles).
+    """
+
+    def __init__(self):
+        self.previous = {}
+        if EXTRACT_STATE_PATH.exists():
+            with open(EXTRACT_STATE_PATH) as f:
+                self.previous = json.load(f)
+        self.current = {}
+        self.delta = {"added": [], "changed": [], "removed": [], "unchanged": 0}
+        # Archives that could not be read and members that could not be extracted
+        self.failed = []
+
+    @staticmethod
+    def key(path):
+        return Path(path).relative_to(RAW_DATA_DIR).as_posix()
+
+    def is_unchanged(self, info, target):
+        """True if `target` on disk already holds this member."""
+        if not target.is_file() or target.stat().st_size != info.file_size:
+            return False
+        recorded = self.previous.get(self.key(target))
+        if recorded is not None:
+            return recorded["crc"] == info.CRC and recorded["size"] == info.file_size
+        # Extracted before the state was kept: fall back to checksumming the file
+        return file_crc32(target) == info.CRC
+
+    def register(self, zip_path, info, target):
+        """Record a member of the current archive; returns True if it must be extracted."""
+        key = self.key(target)
+        self.current[key] = {"crc": info.CRC, "size": info.file_size, "archive": self.key(zip_path)}
+        if self.is_unchanged(info, target):
+            self.delta["unchanged"] += 1
+            return False
+        self.delta["changed" if target.exists() else "added"].append(key)
+        return True
+
+    def forget(self, extract_dir, members):
+        """Members that failed to extract are retried on the next run."""
+        for member in members:
+            self.current.pop(self.key(extract_dir / member), None)
+            self.failed.append(self.key(extract_dir / member))
+
+    def remove_stale(self, archives):
+        """Delete files extracted from `archives` earlier that are no longer in them."""
+        archives = {self.key(a) for a in archives}
+        for key, recorded in self.previous.items():
+            if key in self.current:
+                continue
+            archive_gone = not (RAW_DATA_DIR / recorded["archive"]).exists()
+            if recorded["archive"] in archives or archive_gone:
+                path = RAW_DATA_DIR / key
+                if path.is_file():
+                    path.unlink()
+                if key not in self.delta["removed"]:
+                    self.delta["removed"].append(key)
+
+    def save(self):
+        # Entries of archives that were not looked at in this run are kept as they are
+        for key, recorded in self.previous.items():
+            if key not in self.current and key not in self.delta["removed"]:
+                self.current[key] = recorded
+        with open(EXTRACT_STATE_PATH, 'w') as f:
+            json.dump(self.current, f, indent=1, sort_keys=True)
+        with open(EXTRACT_DELTA_PATH, 'w') as f:
+            json.dump(self.delta, f, indent=1)
+        logger.info(
+            f"Raw files: {len(self.delta['added'])} added, {len(self.delta['changed'])} changed, "
+            f"{len(self.delta['removed'])} removed, {self.delta['unchanged']} unchanged "
+            f"(details in {EXTRACT_DELTA_PATH.relative_to(ROOT_DIR)})"
+        )
+
+def plan_extraction(zip_paths, extract_dirs, state, chunk_bytes=CHUNK_BYTES):
+    """
+    Split every archive into chunks of members of about `chunk_bytes` (uncompressed)
+    and return them as (zip_path, extract_dir, members, chunk_size) tasks, largest
+    archives first and the biggest chunks first within an archive, so the long
+    tasks start early and the small ones fill the gaps at the end. Members that
+    `state` finds unchanged on disk are left out.
+    """
+    tasks = []
+    for zip_path, extract_dir in zip(zip_paths, extract_dirs):
+        try:
+            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                members = [info for info in zip_ref.infolist() if not info.is_dir()]
+        except Exception as e:
+            logger.error(f"Error reading {zip_path}: {e}")
+            state.failed.append(state.key(zip_path))
+            continue
+
+        members = [info for info in members if state.register(zip_path, info, extract_dir / info.filename)]
+
+        # Create the folders up front so the workers never race on makedirs
+        for folder in {PurePosixPath(info.filename).parent for info in members}:
+            (extract_dir / folder).mkdir(parents=True, exist_ok=True)
+
+        archive_size = sum(info.file_size for info in members)
+        chunk, size = [], 0
+        archive_tasks = []
+        for info in sorted(members, key=lambda i: i.file_size, reverse=True):
+            chunk.append(info.filename)
+            size += info.file_size
+            if size >= chunk_bytes:
+                archive_tasks.append((zip_path, extract_dir, chunk, size))
+                chunk, size = [], 0
+        if chunk:
+            archive_tasks.append((zip_path, extract_dir, chunk, size))
+        tasks.extend((archive_size, task) for task in archive_tasks)
+
+    tasks.sort(key=lambda t: (t[0], t[1][3]), reverse=True)
+    return [task for _, task in tasks]
+
+def extract_parallel(tasks, desc, max_workers=None):
+    """
+    Run extraction tasks on a thread pool. Every running task holds one archive
+    handle, so at most `max_workers` archives are open at any time (by default
+    the thread budget of the step).
+    Returns the number of files extracted and the tasks that did not complete.
+    """
+    if not tasks:
+        logger.info(f"{desc}: nothing to extract")
+        return 0, []
+    max_workers = min(max_workers or thread_budget(), len(tasks))
+    total_bytes = sum(task[3] for task in tasks)
+    total_files = 0
+    incomplete = []
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        with tqdm(total=total_bytes, desc=desc, unit="B", unit_scale=True, unit_divisor=1024) as progress:
+            futures = {executor.submit(extract_zip_chunk, task[:3]): task for task in tasks}
+            for future in as_completed(futures):
+                task = futures[future]
+                extracted = future.result()
+                total_files += extracted
+                if extracted < len(task[2]):
+                    incomplete.append(task)
+                progress.update(task[3])
+
+    elapsed = max(time.time() - start_time, 1e-9)
+    logger.info(
+        f"{desc}: {total_files} files, {total_bytes / 1024**2:.1f} MB in {elapsed:.1f}s "
+        f"({total_bytes / 1024**2 / elapsed:.1f} MB/s, {max_workers} workers)"
+    )
+    return total_files, incomplete
 
 def extract_zip():
     if not ZIP_FILE_PATH.exists():
@@ -60,15 +213,20 @@ def extract_zip():
         return False
 
     # --------------------------------------------------------------------------
-    # STEP 1: SINGLE-THREAD extraction of the main ZIP
+    # STEP 1: PARALLEL extraction of the main ZIP
     # --------------------------------------------------------------------------
-    logger.info(f"Extracting all contents of {ZIP_FILE_PATH.name} (single-thread)...")
+    logger.info(f"Extracting all contents of {ZIP_FILE_PATH.name}...")
     try:
-        with zipfile.ZipFile(ZIP_FILE_PATH, 'r') as zip_ref:
-            zip_ref.extractall(RAW_DATA_DIR)
+        with zipfile.ZipFile(ZIP_FILE_PATH, 'r'):
+            pass
     except Exception as e:
         logger.error(f"Error extracting main zip {ZIP_FILE_PATH}: {e}")
         return False
+    state = ExtractionState()
+    _, incomplete = extract_parallel(plan_extraction([ZIP_FILE_PATH], [RAW_DATA_DIR], state), "Extracting main archive")
+    for zip_path, extract_dir, members, _ in incomplete:
+        state.forget(extract_dir, members)
+    state.remove_stale([ZIP_FILE_PATH])
 
     # --------------------------------------------------------------------------
     # STEP 2: FIND NESTED ZIPs (AT ANY DEPTH) INSIDE .../data/raw/
@@ -78,52 +236,43 @@ def extract_zip():
 
     if not nested_zips:
         logger.info("No nested zip files found")
-        return True
+        state.remove_stale([])
+        state.save()
+        return not state.failed
 
     logger.info(f"Found {len(nested_zips)} nested zip files")
 
     # --------------------------------------------------------------------------
-    # STEP 3: SINGLE-THREAD extraction of EACH nested ZIP
+    # STEP 3: PARALLEL extraction of ALL nested ZIPs, split at member level
     # --------------------------------------------------------------------------
-    total_nested_files = 0
-    nested_zip_counts = {}
-    for zip_path in nested_zips:
-        try:
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                file_count = len(zip_ref.namelist())
-                nested_zip_counts[zip_path] = file_count
-                total_nested_files += file_count
-        except Exception as e:
-            logger.error(f"Error reading {zip_path}: {e}")
-
-    nested_progress = tqdm(total=total_nested_files, desc="Extracting nested archives", unit="files")
-
-    # Instead of concurrency, we just call extract_single_zip() in a loop:
-    for zip_path in nested_zips:
-        extracted_count = extract_single_zip(zip_path)
-        nested_progress.update(extracted_count)
-
-    nested_progress.close()
+    tasks = plan_extraction(nested_zips, [zip_path.parent for zip_path in nested_zips], state)
+    _, incomplete = extract_parallel(tasks, "Extracting nested archives")
+    for zip_path, extract_dir, members, _ in incomplete:
+        state.forget(extract_dir, members)
+    # Files of an archive that could not be read are kept until it can be read again
+    state.remove_stale([z for z in nested_zips if state.key(z) not in state.failed])
+    state.save()
+    if state.failed:
+        logger.error(f"Could not extract {len(state.failed)} archives or members: {', '.join(state.failed[:10])}")
+        return False
     return True
 
 def main():
-    try:
-        ensure_directories()
+    ensure_directories()
 
-        memory = psutil.virtual_memory()
-        cpu_percent = psutil.cpu_percent(interval=0.1)
-        logger.info(
-            f"System resources: {os.cpu_count()} CPUs ({cpu_percent}% used), "
-            f"Memory: {memory.percent}% used ({memory.available / (1024**3):.1f}GB available)"
-        )
+    memory = psutil.virtual_memory()
+    cpu_percent = psutil.cpu_percent(interval=0.1)
+    logger.info(
+        f"System resources: {os.cpu_count()} CPUs ({cpu_percent}% used), "
+        f"Memory: {memory.percent}% used ({memory.available / (1024**3):.1f}GB available)"
+    )
 
-        if extract_zip():
-            logger.info("Data extraction completed successfully")
-        else:
-            logger.error("Data extraction failed")
-
-    except Exception as e:
-        logger.error(f"Unhandled exception: {str(e)}")
+    # A failed extraction must fail the step, or the manifest records it as up to date
+    if extract_zip():
+        logger.info("Data extraction completed successfully")
+    else:
+        logger.error("Data extraction failed")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
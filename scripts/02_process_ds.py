@@ -1,12 +1,32 @@
+import csv
+import os
+import re
+from datetime import datetime
+from itertools import islice
+
+import numpy as np
 import polars as pl
+import pyarrow.parquet as pq
 import pathos.multiprocessing as mp
 
 from tqdm import tqdm
 from pathlib import Path
 from loguru import logger
 
+from raw_source import ConvertedRawFiles, list_raw_files, raw_folder_exists
+from resources import memory_budget, process_budget
+
+# Date column headers: dd/mm/yyyy, sometimes followed by more text
+HEADER_DATE = re.compile(r"^(\d{2}/\d{2}/\d{4})")
+
 class DatastreamProcessor:
-   def __init__(self):
+   # Memory of a worker process besides its chunk (interpreter, Polars, Arrow)
+   WORKER_BASE_BYTES = 256 * 1024**2
+   # Memory per cell of a chunk while it is converted: CSV text, wide Float64
+   # frame (and its copy in code order) and its NumPy copy, masks and the long frame
+   CELL_BYTES = 120
+
+   def __init__(self, chunk_rows=1000):
        self.root_dir = Path(__file__).resolve().parents[1]
        self.raw_dir = self.root_dir / "data" / "raw"
        self.interim_dir = self.root_dir / "data" / "interim"
@@ -17,6 +37,11 @@ class DatastreamProcessor:
        self.interim_dir.mkdir(parents=True, exist_ok=True)
        self.output_dir = self.interim_dir / "datastream"
        self.output_dir.mkdir(exist_ok=True)
+       # First/last date and gap count per security and file
+       self.coverage_dir = self.output_dir / "coverage"
+       self.coverage_dir.mkdir(exist_ok=True)
+       # Securities (rows of the wide file) converted at a time
+       self.chunk_rows = chunk_rows
        
        self.data_dirs = [
            self.ds_dir / "Daily Index Returns LC",
@@ -28,10 +53,34 @@ class DatastreamProcessor:
        ]
        
    def find_csv_files(self):
-       all_csvs = [file for folder in self.data_dirs for file in folder.rglob("*.csv")]
+       all_csvs = [file for folder in self.data_dirs for file in list_raw_files(folder, "*.csv")]
        logger.info(f"Found {len(all_csvs)} CSV files to process")
        return all_csvs
    
+   def date_columns(self, filepath):
+       """Number of date columns of a wide file, from its header."""
+       with filepath.open() as source:
+           source.readline()  # title line
+           return len(self.parse_header(source.readline())[1])
+
+   def worker_memory(self, csv_files):
+       """
+       Estimated peak memory of one worker: a chunk of `chunk_rows` securities of
+       the widest file, as text, wide frame and long frame at the same time.
+       """
+       widest = max(self.date_columns(f) for f in csv_files)
+       return self.WORKER_BASE_BYTES + self.chunk_rows * widest * self.CELL_BYTES
+
+   def worker_count(self, csv_files):
+       """Worker processes: the step's process budget, as far as the memory budget allows."""
+       per_worker = self.worker_memory(csv_files)
+       by_memory = max(1, memory_budget() // per_worker)
+       num_processes = min(process_budget(), len(csv_files), by_memory)
+       if num_processes == by_memory < process_budget():
+           logger.warning(f"Memory limits the pool to {num_processes} workers "
+                          f"(about {per_worker / 1024**3:.1f} GB each)")
+       return num_processes
+
    def process_file(self, filepath):
        try:
            file_dir = filepath.parent.name
@@ -46,10 +95,91 @@ class DatastreamProcessor:
            logger.error(f"Error processing {filepath}: {str(e)}")
            return (False, filepath, str(e), 0)
 
+   @staticmethod
+   def parse_header(header_line):
+       """
+       Column names of a wide file and the date of every date column, decoded once
+       per file. Columns 8+ carry the dates as dd/mm/yyyy, possibly with a suffix.
+       """
+       columns = next(csv.reader([header_line.decode("us-ascii")]))
+       dates = {}
+       for column in columns[7:]:
+           match = HEADER_DATE.match(column)
+           if match:
+               dates[column] = datetime.strptime(match.group(1), "%d/%m/%Y").date()
+       return columns, dates
+
+   def read_chunks(self, source, chunk_rows):
+       """
+       Yields (dates, DataFrame) for consecutive chunks of `chunk_rows`
+       securities, with the date columns parsed as Float64 directly.
+       """
+       source.readline()  # title line
+       header_line = source.readline()
+       columns, dates = self.parse_header(header_line)
+       if len(dates) < len(columns) - 7:
+           logger.warning(f"Ignoring {len(columns) - 7 - len(dates)} columns without a date header")
+       schema = {column: pl.String for column in columns[:7]}
+       schema.update({column: pl.Float64 for column in columns[7:]})
+
+       while True:
+           lines = list(islice(source, chunk_rows))
+           if not lines:
+               break
+           chunk = pl.read_csv(
+               header_line + b"".join(lines),
+               quote_char='"',
+               schema_overrides=schema,
+               ignore_errors=True  # non-numeric cells (e.g. "NA") become null
+           )
+           yield dates, chunk
+
+   @staticmethod
+   def active_cells(chunk, dates, value_col, currency):
+       """
+       Long (DSCode, Date, value, Currency) rows of a wide chunk, restricted to
+       each security's active range: the dates between its first and last
+       non-null value. Dates before listing and after delisting are dropped;
+       missing values inside the range are kept as nulls. Also returns the
+       coverage of every security (first/last date, observations, gaps).
+
+       The rows are sorted by DSCode and Date, so every chunk is a sorted run
+       for the merge in step 06; securities without a code are dropped.
+       """
+       chunk = chunk.filter(pl.col("DATES").is_not_null()).sort("DATES", maintain_order=True)
+       date_series = pl.Series("Date", list(dates.values()), dtype=pl.Date)
+       values = chunk.select(list(dates)).to_numpy()
+       observed = ~np.isnan(values)
+       listed = observed.any(axis=1)
+       first = observed.argmax(axis=1)
+       last = len(dates) - 1 - observed[:, ::-1].argmax(axis=1)
+       positions = np.arange(len(dates))
+       active = (positions >= first[:, None]) & (positions <= last[:, None]) & listed[:, None]
+
+       # Row-major order: the rows of a security are stored together, by date
+       rows, columns = np.nonzero(active)
+       codes = chunk["DATES"]
+       long_df = pl.DataFrame([
+           codes.gather(rows).alias("DSCode"),
+           date_series.gather(columns),
+           pl.Series(value_col, values[rows, columns]).fill_nan(None),
+       ]).with_columns(pl.lit(currency, dtype=pl.Utf8).alias("Currency"))
+
+       observations = observed.sum(axis=1)
+       coverage = pl.DataFrame({
+           "DSCode": codes,
+           "Currency": pl.Series([currency] * chunk.height, dtype=pl.Utf8),
+           "Item": pl.Series([value_col] * chunk.height, dtype=pl.Utf8),
+           "first_date": date_series.gather(first),
+           "last_date": date_series.gather(last),
+           "observations": observations,
+           "gaps": active.sum(axis=1) - observations,
+       }).filter(pl.Series(listed))
+       return long_df, coverage
+
    def process_non_index_file(self, filepath):
        try:
-           file_path = Path(filepath)
-           file_name = file_path.stem
+           file_name = filepath.stem
            
            currency = "Unknown"
            path_str = str(filepath)
@@ -58,66 +188,50 @@ class DatastreamProcessor:
            elif "USD" in path_str:
                currency = "USD"
            
-           # 1) Restrict Polars to 1 thread
-           df = pl.read_csv(
-               filepath,
-               encoding="us-ascii",
-               skip_rows=1,
-               quote_char='"',
-               infer_schema_length=0,
-               n_threads=1  # <-- ADDED
-           )
-           
-           meta_cols = ["DATES"]
-           date_cols = df.columns[7:]
            value_col_name = "MV" if "MV" in file_name else "RI"
-           
-           result_df = (
-               df.melt(
-                   id_vars=meta_cols,
-                   value_vars=date_cols,
-                   variable_name="Date",
-                   value_name="Value"
-               )
-               .with_columns([
-                   pl.lit(currency).alias("Currency"),
-                   pl.col("Value").cast(pl.Float64, strict=False),
-                   pl.col("Date").str.extract(r"^(\d{2}/\d{2}/\d{4}).*", 1).alias("CleanDate")
-               ])
-               .with_columns([
-                   pl.when(pl.col("CleanDate") == "")
-                   .then(pl.col("Date"))
-                   .otherwise(pl.col("CleanDate"))
-                   .alias("CleanDate")
-               ])
-               .rename({"DATES": "DSCode", "Value": value_col_name})
-               .with_columns([
-                   pl.col("DSCode").cast(pl.Utf8),
-                   pl.col("Currency").cast(pl.Utf8)
-               ])
-           )
+           output_path = self.output_dir / f"{file_name}.parquet"
+           tmp_path = output_path.with_suffix(".parquet.tmp")
+           writer = None
+           row_count = 0
+           cell_count = 0
+           coverage = []
 
-           # 2) Convert the date string if possible
+           # Threads per worker come from POLARS_MAX_THREADS, set by the scheduler.
+           # Only one chunk of securities is held in memory, in wide and long form.
+           # Each chunk is written as one row group flagged as sorted by DSCode, Date.
            try:
-               result_df = (
-                   result_df
-                   .with_columns([
-                       pl.col("CleanDate").str.strptime(pl.Date, "%d/%m/%Y", strict=True).alias("Date")
-                   ])
-                   .drop("CleanDate")
-               )
-           except Exception as date_err:
-               logger.warning(f"Error converting dates: {str(date_err)}")
-               result_df = result_df.rename({"CleanDate": "Date"})
-           
-           if result_df.height == 0:
+               with filepath.open() as source:
+                   for dates, chunk in self.read_chunks(source, self.chunk_rows):
+                       cell_count += chunk.height * len(dates)
+                       result_df, chunk_coverage = self.active_cells(chunk, dates, value_col_name, currency)
+                       coverage.append(chunk_coverage)
+                       if result_df.height == 0:
+                           continue
+                       table = result_df.to_arrow()
+                       if writer is None:
+                           writer = pq.ParquetWriter(
+                               tmp_path, table.schema, compression="zstd",
+                               sorting_columns=[pq.SortingColumn(0), pq.SortingColumn(1)],
+                           )
+                       writer.write_table(table, row_group_size=table.num_rows)
+                       row_count += result_df.height
+           finally:
+               if writer is not None:
+                   writer.close()
+
+           coverage_path = self.coverage_dir / f"{file_name}.parquet"
+           if row_count == 0:
+               # A delivery without data replaces the earlier one: its outputs must not be merged again
+               tmp_path.unlink(missing_ok=True)
+               output_path.unlink(missing_ok=True)
+               coverage_path.unlink(missing_ok=True)
                logger.warning(f"No data found in {filepath}")
-               return (False, filepath, "No data rows found", 0)
-           
-           output_path = self.output_dir / f"{file_name}.parquet"
-           result_df.write_parquet(output_path)
-           
-           return (True, filepath, None, result_df.height)
+               return (True, filepath, "No data rows found", 0)
+
+           os.replace(tmp_path, output_path)
+           pl.concat(coverage).write_parquet(coverage_path)
+           logger.debug(f"{filepath.name}: kept {row_count:,} of {cell_count:,} cells inside the active ranges")
+           return (True, filepath, None, row_count)
            
        except Exception as e:
            logger.error(f"Error processing {filepath}: {str(e)}")
@@ -126,40 +240,68 @@ class DatastreamProcessor:
    def run(self):
        logger.info("Starting Datastream CSV processing")
        
-       if not self.ds_dir.exists():
-           logger.error(f"Datastream directory not found: {self.ds_dir}")
-           return
+       if not raw_folder_exists(self.ds_dir):
+           raise FileNotFoundError(f"Datastream directory not found: {self.ds_dir}")
        
        csv_files = self.find_csv_files()
+       converted = ConvertedRawFiles(
+           self.output_dir / ".converted_raw.json",
+           lambda f: [self.output_dir / f"{f.stem}.parquet", self.coverage_dir / f"{f.stem}.parquet"],
+       )
+       converted.remove_orphaned()
+       # Index files are not converted; do not hand them to the pool at all
+       csv_files = [f for f in csv_files if "Index Returns" not in f.parent.name]
+       csv_files = converted.select(csv_files)
        
        if not csv_files:
            logger.warning("No CSV files found!")
            return
        
-       # 3) Use fewer processes to avoid resource limits
-       num_processes = min(mp.cpu_count(), 4)  # <-- CHANGED from mp.cpu_count() to 4
-       logger.info(f"Using {num_processes} CPU cores for parallel processing")
+       # Largest files first: with one file per task, a big regional file can no
+       # longer start last and hold up the end of the step
+       csv_files.sort(key=lambda f: f.size, reverse=True)
+       num_processes = self.worker_count(csv_files)
+       logger.info(f"Using {num_processes} worker processes for parallel processing")
        
        success_count = 0
        total_rows = 0
+       failed = []
        
-       # Process CSVs in parallel, but with limited concurrency
-       with mp.Pool(processes=num_processes) as pool:
+       # Process CSVs in parallel
+       # Every worker builds its own processor once; a task only carries the file
+       with mp.Pool(processes=num_processes, initializer=init_worker, initargs=(self.chunk_rows,)) as pool:
            with tqdm(total=len(csv_files), desc="Processing CSV files") as pbar:
-               for success, _, _, row_count in pool.imap_unordered(self.process_file, csv_files):
+               for success, filepath, _, row_count in pool.imap_unordered(convert_file, csv_files, chunksize=1):
                    if success:
+                       converted.mark_converted(filepath)
                        success_count += 1
                        if isinstance(row_count, tuple):
                            total_rows += sum(row_count)
                        else:
                            total_rows += row_count
+                   else:
+                       failed.append(filepath.name)
                    pbar.update(1)
        
+       converted.save()
+       # The step must fail, or the manifest records the old outputs as up to date
+       if failed:
+           raise RuntimeError(f"Processing failed for: {', '.join(sorted(failed))}")
        logger.success(f"Processing complete: {success_count}/{len(csv_files)} files processed successfully")
        logger.info(f"Total rows processed: {total_rows:,}")
        
        return success_count, len(csv_files)
 
+# Processor of a pool worker, created by init_worker
+_worker_processor = None
+
+def init_worker(chunk_rows):
+   global _worker_processor
+   _worker_processor = DatastreamProcessor(chunk_rows)
+
+def convert_file(filepath):
+   return _worker_processor.process_file(filepath)
+
 def main():
    processor = DatastreamProcessor()
    processor.run()
@@ -1,37 +1,50 @@
+import collections
 import concurrent.futures
-import os
+import io
 import re
+import threading
 from pathlib import Path
 
-import pandas as pd
-import pathos.multiprocessing as mp
+import polars as pl
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
 import pyarrow.parquet as pq
 from loguru import logger
 from tqdm import tqdm
 
-WS_FILE_COLUMNS = {
-    "WSCalendarPrd":             ["ws_id", "point_date", "freq", "fiscal_period", "item_code", "value"],
-    "WSCurrent":                 ["ws_id", "point_date", "item_code", "value"],
-    "WSCurrentFootnote":         ["ws_id", "point_date", "item_code", "note"],
-    "WSFV":                      ["ws_id", "point_date", "freq", "fiscal_period", "item_code", "value"],
-    "WSFVFootnote":              ["ws_id", "point_date", "freq", "fiscal_period", "item_code", "note"],
-    "WSIndex":                   ["ws_id", "point_date", "index_name", "item_code", "value"],
-    "WSMetaData":                ["ws_id", "point_date", "freq", "fiscal_period", "item_code", "value"],
-    "WSMetaDataFootnote":        ["ws_id", "point_date", "freq", "fiscal_period", "item_code", "note"],
-    "WSMonthlyPricing":          ["ws_id", "point_date", "item_code", "value"],
-    "WSMonthlyPricingFootnote":  ["ws_id", "point_date", "item_code", "note"],
-    "WSRatios":                  ["ws_id", "point_date", "freq", "fiscal_period", "item_code", "value"],
-    "WSRatiosFootnote":          ["ws_id", "point_date", "freq", "fiscal_period", "item_code", "note"],
-    "WSReportedPrd":             ["ws_id", "point_date", "freq", "item_code", "value"],
-    "WSSegment":                 ["ws_id", "point_date", "freq", "fiscal_period", "segment_type", "segment_id", "item_code", "value"],
-    "WSSegmentFootnote":         ["ws_id", "point_date", "freq", "fiscal_period", "segment_type", "segment_id", "item_code", "note"],
-    "WSSupplemental":            ["ws_id", "point_date", "freq", "fiscal_period", "item_code", "value"],
-    "WSSupplementalFootnote":    ["ws_id", "point_date", "freq", "fiscal_period", "item_code", "note"],
-    "WSWeeklyPricing":           ["ws_id", "point_date", "item_code", "value"],
-    "WSWeeklyPricingFootnote":   ["ws_id", "point_date", "item_code", "note"],
+from raw_source import ConvertedRawFiles, RawFile, list_raw_files, raw_folder_exists
+from resources import thread_budget
+from worldscope_store import write_sorted
+from ws_ingestion import DATE_ITEMS, TEXT_ITEMS, WS_FILE_COLUMNS, ingestion_plan
+
+# Parquet types of the typed columns; all other columns are stored as strings
+WS_COLUMN_TYPES = {
+    "point_date":    pa.timestamp("us"),
+    "fiscal_period": pa.int64(),
+    "item_code":     pa.int64(),
 }
 
+# The value column is stored as three typed columns, filled by item type (see ws_ingestion.py)
+VALUE_COLUMNS = [("value", pa.float64()), ("value_date", pa.date32()), ("value_text", pa.string())]
+
+INTEGER = r"^-?\d+$"
+NUMBER = r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$"
+
+
+def ws_schema(columns):
+    return pa.schema([(column, WS_COLUMN_TYPES.get(column, pa.string())) for column in columns])
+
+def output_schema(columns):
+    """Schema of the parquet file: the value column is split into VALUE_COLUMNS."""
+    fields = []
+    for field in ws_schema(columns):
+        if field.name == "value" and "item_code" in columns:
+            fields.extend(VALUE_COLUMNS)
+        else:
+            fields.append(field)
+    return pa.schema(fields)
+
 class WorldscopeProcessor:
     def __init__(self):
         self.root_dir = Path(__file__).resolve().parents[1]
@@ -45,63 +58,170 @@ class WorldscopeProcessor:
         self.output_dir = self.interim_dir / "worldscope"
         self.output_dir.mkdir(exist_ok=True)
 
+        # Blocks of all files are parsed on one pool of the step's threads; at most
+        # two blocks per thread are in flight, so memory does not grow with file size
+        self.block_pool = concurrent.futures.ThreadPoolExecutor(max_workers=thread_budget())
+        self.block_slots = threading.BoundedSemaphore(2 * thread_budget())
+
     def find_txt_files(self):
-        txts = list(self.ws_dir.rglob("*.txt"))
+        txts = list_raw_files(self.ws_dir, "*.txt")
         logger.info(f"Found {len(txts)} Worldscope .txt files")
         return txts
 
+    @staticmethod
+    def file_type(filepath):
+        return filepath.name.split("_")[0]
+
     def get_columns(self, filepath):
-        file_type = filepath.name.split("_")[0]
+        file_type = self.file_type(filepath)
         if file_type in WS_FILE_COLUMNS:
             return WS_FILE_COLUMNS[file_type]
         else:
             raise ValueError(f"Unknown Worldscope file type: {file_type}")
 
-    def convert_to_parquet(self, input_file_path, chunk_size=100_000, separator='|'):
-        input_file_path = Path(input_file_path)
+    @staticmethod
+    def typed_batch(batch, schema):
+        """
+        Converts a batch read as text to `schema`. Dates (yyyymmdd) and integers
+        that do not parse become nulls instead of failing the file.
+        """
+        arrays = []
+        for field, array in zip(schema, batch.columns):
+            if pa.types.is_timestamp(field.type):
+                array = pc.strptime(array, format="%Y%m%d", unit=field.type.unit, error_is_null=True)
+            elif pa.types.is_integer(field.type):
+                array = pc.utf8_trim_whitespace(array)
+                array = pc.if_else(pc.match_substring_regex(array, INTEGER), array, pa.scalar(None, pa.string()))
+                array = pc.cast(array, field.type)
+            arrays.append(array)
+        return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+    @staticmethod
+    def split_values(table, schema):
+        """
+        Replaces the value strings of `table` by the typed columns of `schema`:
+        dates of DATE_ITEMS, text of TEXT_ITEMS and numbers of all other items.
+        Values of other items that are not numbers are kept as text. Quotes
+        around or inside the values are removed first.
+        """
+        codes = table["item_code"]
+        raw = pc.utf8_trim_whitespace(pc.replace_substring(table["value"], '"', ''))
+        is_date = pc.is_in(codes, value_set=pa.array(sorted(DATE_ITEMS), pa.int64()))
+        is_text = pc.is_in(codes, value_set=pa.array(sorted(TEXT_ITEMS), pa.int64()))
+        is_number = pc.and_(
+            pc.invert(pc.or_(is_date, is_text)),
+            pc.fill_null(pc.match_substring_regex(raw, NUMBER), False),
+        )
+
+        numbers = pc.cast(pc.if_else(is_number, raw, pa.scalar(None, pa.string())), pa.float64())
+        if pc.any(is_date).as_py():
+            dates = pc.strptime(
+                pc.replace_substring_regex(raw, r"^d", ""), format="%Y%m%d", unit="s", error_is_null=True
+            )
+            dates = pc.if_else(is_date, pc.cast(dates, pa.date32()), pa.scalar(None, pa.date32()))
+        else:
+            dates = pa.nulls(len(table), pa.date32())
+        text = pc.if_else(pc.or_(is_date, is_number), pa.scalar(None, pa.string()), raw)
+
+        typed = {"value": numbers, "value_date": dates, "value_text": text}
+        return pa.table(
+            [typed[name] if name in typed else table[name] for name in schema.names], schema=schema
+        )
+
+    @staticmethod
+    def read_blocks(source, block_size):
+        """Newline-aligned blocks of about `block_size` bytes of `source`, in file order."""
+        rest = b""
+        while True:
+            data = source.read(block_size)
+            if not data:
+                break
+            data = rest + data
+            end = data.rfind(b"\n") + 1
+            rest = data[end:]
+            if end:
+                yield data[:end]
+        if rest:
+            yield rest
+
+    def parse_block(self, data, columns, parse_schema, file_schema, separator, item_codes=None):
+        """
+        One block of a .txt file as a table of `file_schema`, keeping only the
+        rows of `item_codes` if given.
+        """
+        # Most blocks are plain ASCII, which needs no transcoding
+        if not data.isascii():
+            data = data.decode('windows-1252').encode('utf-8')
+        table = pv.read_csv(
+            pa.py_buffer(data),
+            read_options=pv.ReadOptions(column_names=columns, use_threads=False),
+            parse_options=pv.ParseOptions(delimiter=separator),
+            convert_options=pv.ConvertOptions(
+                column_types={column: pa.string() for column in columns}, strings_can_be_null=True
+            ),
+        )
+        table = pa.Table.from_batches(
+            [self.typed_batch(batch, parse_schema) for batch in table.to_batches()], schema=parse_schema
+        )
+        if item_codes is not None:
+            table = table.filter(pc.is_in(table["item_code"], value_set=item_codes))
+        if file_schema != parse_schema:
+            table = self.split_values(table, file_schema)
+        return table
+
+    def convert_to_parquet(self, input_file_path, item_codes=None, block_size=16 << 20, separator='|'):
+        if not isinstance(input_file_path, RawFile):
+            input_file_path = RawFile(input_file_path)
         input_filename = input_file_path.stem
         output_file = self.output_dir / f"{input_filename}.parquet"
+        unsorted_file = self.output_dir / f"{input_filename}.unsorted"
 
         file_type_match = re.match(r'(WS[a-zA-Z]+)', input_filename)
         if file_type_match and file_type_match.group(1) in WS_FILE_COLUMNS:
             schema = WS_FILE_COLUMNS[file_type_match.group(1)]
         else:
             # fallback: try to read first line as header
-            with open(input_file_path, 'r', encoding='windows-1252') as f:
+            with io.TextIOWrapper(input_file_path.open(), encoding='windows-1252') as f:
                 first_line = f.readline().strip()
                 schema = first_line.split(separator)
 
         writer = None
         total_rows = 0
+        parse_schema = ws_schema(schema)
+        file_schema = output_schema(schema)
+        if item_codes is not None:
+            item_codes = pa.array(sorted(item_codes), pa.int64())
+        pending = collections.deque()
+
+        def write_next():
+            # Blocks are written in file order, so the row order does not depend on the threads
+            future = pending.popleft()
+            try:
+                table = future.result()
+            finally:
+                self.block_slots.release()
+            writer.write_table(table)
+            return table.num_rows
 
+        # The file is cut into newline-aligned blocks that are parsed in parallel on
+        # the shared block pool and written to a scratch file in file order, which is
+        # then sorted into the layout of worldscope_store.py
         try:
-            for chunk_df in pd.read_csv(
-                input_file_path,
-                sep=separator,
-                chunksize=chunk_size,
-                header=None,
-                names=schema,
-                dtype_backend='pyarrow',
-                encoding='windows-1252'
-            ):
-                if "point_date" in chunk_df.columns:
-                    chunk_df["point_date"] = pd.to_datetime(
-                        chunk_df["point_date"], format="%Y%m%d", errors="coerce"
-                    )
-                for col in ["fiscal_period", "item_code"]:
-                    if col in chunk_df.columns:
-                        chunk_df[col] = pd.to_numeric(chunk_df[col], errors="coerce")
-
-                table = pa.Table.from_pandas(chunk_df, preserve_index=False)
-
-                if writer is None:
-                    writer = pq.ParquetWriter(output_file, table.schema, compression='zstd')
-
-                writer.write_table(table)
-                total_rows += len(chunk_df)
+            with input_file_path.open() as source:
+                writer = pq.ParquetWriter(unsorted_file, file_schema, compression='lz4')
+                for block in self.read_blocks(source, block_size):
+                    # Wait for a free slot, writing our own finished blocks meanwhile
+                    while not self.block_slots.acquire(blocking=False):
+                        if not pending:
+                            self.block_slots.acquire()
+                            break
+                        total_rows += write_next()
+                    pending.append(self.block_pool.submit(self.parse_block, block, schema, parse_schema, file_schema, separator, item_codes))
+                while pending:
+                    total_rows += write_next()
 
-            if writer:
-                writer.close()
+            writer.close()
+            total_rows = write_sorted(pl.scan_parquet(unsorted_file), output_file, file_schema)
 
             return (True, input_file_path, None, total_rows)
 
@@ -109,44 +229,78 @@ class WorldscopeProcessor:
             logger.error(f"Error processing {input_file_path}: {e}")
             return (False, input_file_path, str(e), 0)
         finally:
+            # Give back the slots of blocks that are not written after an error
+            for future in pending:
+                if not future.cancel():
+                    future.exception()
+                self.block_slots.release()
             if writer:
                 writer.close()
+            unsorted_file.unlink(missing_ok=True)
 
     def run(self):
         logger.info("Starting Worldscope .txt processing")
 
-        if not self.ws_dir.exists():
-            logger.error(f"Worldscope directory not found: {self.ws_dir}")
-            return
+        if not raw_folder_exists(self.ws_dir):
+            raise FileNotFoundError(f"Worldscope directory not found: {self.ws_dir}")
 
         txt_files = self.find_txt_files()
+
+        # Only the file types and items the later steps use (see ws_ingestion.py)
+        plan = ingestion_plan()
+        if plan is None:
+            logger.info("Ingesting all Worldscope files and items")
+        else:
+            skipped = [f for f in txt_files if self.file_type(f) not in plan]
+            txt_files = [f for f in txt_files if self.file_type(f) in plan]
+            logger.info(
+                f"Ingestion plan: {', '.join(f'{t} ({len(codes)} items)' for t, codes in plan.items())}; "
+                f"skipping {len(skipped)} files of other types"
+            )
+        converted = ConvertedRawFiles(self.output_dir / ".converted_raw.json",
+                                      lambda f: [self.output_dir / f"{f.stem}.parquet"])
+        converted.remove_orphaned()
+        # A file converted with other item codes counts as changed
+        item_codes = lambda f: None if plan is None else sorted(plan[self.file_type(f)])
+        txt_files = converted.select(txt_files, item_codes)
         if not txt_files:
             logger.warning("No .txt files found!")
             return
 
-        # Original: num_processes = mp.cpu_count()
-        # We'll still read that, but we'll keep the concurrency lower for threads
-        num_processes = mp.cpu_count()
-        logger.info(f"Detected {num_processes} CPU cores")
-
-        # (2) Limit the ThreadPool to avoid resource or concurrency issues
-        max_threads = min(os.cpu_count(), 4)
+        # One thread per CPU of this step's budget reads and writes files; the parsing
+        # runs on the block pool. Largest files first, so their blocks start early.
+        pa.set_cpu_count(thread_budget())
+        txt_files.sort(key=lambda f: f.size, reverse=True)
+        max_threads = min(thread_budget(), len(txt_files))
         logger.info(f"Using {max_threads} threads for processing")
 
         success_count = 0
         total_rows = 0
+        failed = []
 
         with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
             with tqdm(total=len(txt_files), desc="Processing WS .txt files") as pbar:
-                future_to_file = {executor.submit(self.convert_to_parquet, file): file for file in txt_files}
+                future_to_file = {
+                    executor.submit(self.convert_to_parquet, file, None if plan is None else plan[self.file_type(file)]): file
+                    for file in txt_files
+                }
 
                 for future in concurrent.futures.as_completed(future_to_file):
                     success, _, _, row_count = future.result()
+                    file = future_to_file[future]
 
                     if success:
+                        converted.mark_converted(file, item_codes(file))
                         success_count += 1
                         total_rows += row_count
+                    else:
+                        failed.append(file.name)
                     pbar.update(1)
+        self.block_pool.shutdown()
+        converted.save()
+        # The step must fail, or the manifest records the old outputs as up to date
+        if failed:
+            raise RuntimeError(f"Processing failed for: {', '.join(sorted(failed))}")
 
         logger.success(
             f"Worldscope processing complete: "
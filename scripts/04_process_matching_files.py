@@ -1,14 +1,35 @@
 import concurrent.futures
-import os
 from pathlib import Path
 
-import pandas as pd
+import polars as pl
 import pyarrow as pa
-import pyarrow.parquet as pq
+import pyarrow.csv as pv
 from loguru import logger
 from tqdm import tqdm
 
+from out_of_core import write_parquet
+from raw_source import list_raw_files, raw_folder_exists
+from resources import thread_budget
+
 class MatchingFileProcessor:
+    """
+    Builds the consolidated universal matching file straight from the matching
+    CSVs: only the needed columns are read (one file per thread) and for every
+    (DSCD, WC06105) pair the most recent record (by TIME) is kept. The CSVs
+    are streamed block by block (Arrow decodes windows-1252 on the fly) and
+    every block is folded into the reduced records of its file right away, so
+    memory grows with the number of distinct pairs and dates, not with the size
+    of the files. Records of the same date keep the order of the files (by name)
+    and of their rows. The result is ordered most recent record first.
+
+    Next to it, the link history lists the Worldscope id of every Datastream
+    code at each date it was recorded; step 05 turns it into the validity
+    intervals of the links.
+    """
+
+    # Bytes of CSV decoded per block
+    BLOCK_BYTES = 64 * 1024**2
+
     def __init__(self):
         self.root_dir = Path(__file__).resolve().parents[1]
         self.raw_dir = self.root_dir / "data" / "raw"
@@ -18,88 +39,123 @@ class MatchingFileProcessor:
         self.interim_dir.mkdir(parents=True, exist_ok=True)
         self.output_dir = self.interim_dir / "universal matching file"
         self.output_dir.mkdir(exist_ok=True)
+        self.output_file = self.output_dir / "UniverseMatchingFile_consolidated.parquet"
+        self.history_file = self.output_dir / "UniverseMatchingFile_history.parquet"
 
-        self.columns_to_keep = ["DSCD", "ISIN", "LOC", "GEOGC", "WC06105"]
+        self.columns_to_keep = ["DSCD", "ISIN", "LOC", "GEOGC", "WC06105", "TIME"]
+        self.key_columns = ["DSCD", "WC06105"]
 
     def find_csv_files(self):
-        csv_files = list(self.matching_dir.glob("*.csv"))
-        csv_files = [csv for csv in csv_files if not os.path.getsize(csv) == 0]
+        csv_files = list_raw_files(self.matching_dir, "*.csv", recursive=False)
+        csv_files = sorted((csv for csv in csv_files if not csv.size == 0), key=lambda csv: csv.name)
         logger.info(f"Found {len(csv_files)} matching CSV files to process")
         return csv_files
 
-    def convert_to_parquet(self, input_file_path, chunk_size=100_000):
-        input_file_path = Path(input_file_path)
-        input_filename = input_file_path.stem
-        output_file = self.output_dir / f"{input_filename}.parquet"
-
-        writer = None
-        total_rows = 0
-
-        try:
-            for chunk_df in pd.read_csv(
-                input_file_path,
-                chunksize=chunk_size,
-                dtype_backend='pyarrow',
-                encoding="windows-1252"
-            ):
-
-                table = pa.Table.from_pandas(chunk_df, preserve_index=False)
-
-                if writer is None:
-                    writer = pq.ParquetWriter(output_file, table.schema, compression='zstd')
-
-                writer.write_table(table)
-                total_rows += len(chunk_df)
-
-            if writer:
-                writer.close()
-
-            return (True, input_file_path, None, total_rows)
-
-        except Exception as e:
-            logger.error(f"Error processing {input_file_path}: {e}")
-            return (False, input_file_path, str(e), 0)
-        finally:
-            if writer:
-                writer.close()
+    def read_csv(self, file_index, input_file_path):
+        """
+        The latest records and the link history (see below) of one matching CSV
+        and its number of rows. The needed columns are read as strings (empty and
+        missing values are null), one block at a time.
+        """
+        latest, history, rows = None, None, 0
+        with input_file_path.open() as source:
+            reader = pv.open_csv(
+                source,
+                read_options=pv.ReadOptions(encoding="windows-1252", use_threads=False, block_size=self.BLOCK_BYTES),
+                convert_options=pv.ConvertOptions(
+                    include_columns=self.columns_to_keep,
+                    include_missing_columns=True,
+                    column_types={column: pa.string() for column in self.columns_to_keep},
+                    strings_can_be_null=True,
+                ),
+            )
+            for batch in reader:
+                records = self.records(batch, file_index, rows)
+                rows += batch.num_rows
+                latest = self.latest_records(records if latest is None else pl.concat([latest, records]))
+                history = self.link_history(records if history is None else pl.concat([history, records.select(history.columns)]))
+        if latest is None:
+            records = self.records(reader.schema.empty_table(), file_index, 0)
+            latest, history = self.latest_records(records), self.link_history(records)
+        return latest, history, rows
+
+    @staticmethod
+    def records(batch, file_index, first_row):
+        """
+        The records of `batch` with the parsed TIME (_date) and their position in
+        file order: the file (_file) and the row within it (_row).
+        """
+        return pl.from_arrow(pa.table(batch)).with_columns(
+            pl.col("TIME").str.strptime(pl.Date, "%d/%m/%Y", strict=False).alias("_date"),
+            pl.lit(file_index, dtype=pl.Int64).alias("_file"),
+            pl.int_range(first_row, first_row + pl.len(), dtype=pl.Int64).alias("_row"),
+        )
+
+    def latest_records(self, records):
+        """
+        The most recent record of every (DSCD, WC06105) pair of `records`, most
+        recent first; of several records of the same date the first in file
+        order. Reducing part of the records first gives the same result.
+        """
+        return (
+            records.sort(["_date", "_file", "_row"], descending=[True, False, False], nulls_last=True)
+            .unique(subset=self.key_columns, keep="first", maintain_order=True)
+        )
+
+    @staticmethod
+    def link_history(records):
+        """
+        DSCD, _date, WC06105 (with their position): the Worldscope id recorded
+        for a Datastream code on each date (null if the record has none). Of
+        several records of a code on one date the first in file order counts.
+        """
+        return (
+            records.filter(pl.col("DSCD").is_not_null())
+            .sort(["_file", "_row"])
+            .unique(subset=["DSCD", "_date"], keep="first", maintain_order=True)
+            .select(["DSCD", "_date", "WC06105", "_file", "_row"])
+        )
+
+    def remove_file_copies(self):
+        """Per-file parquet copies written by earlier versions of this step."""
+        for f in self.output_dir.glob("*.parquet"):
+            if f not in (self.output_file, self.history_file):
+                f.unlink()
 
     def run(self):
         logger.info("Starting Matching file processing")
 
-        if not self.matching_dir.exists():
-            logger.error(f"Matching directory not found: {self.matching_dir}")
-            return
+        if not raw_folder_exists(self.matching_dir):
+            raise FileNotFoundError(f"Matching directory not found: {self.matching_dir}")
 
         csv_files = self.find_csv_files()
         if not csv_files:
             logger.warning("No CSV files found!")
             return
 
-        success_count = 0
-        total_rows = 0
-
-        max_threads = os.cpu_count()
-
+        # The consolidated file depends on every matching file, so all of them are read
+        max_threads = min(thread_budget(), len(csv_files))
         with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
-            with tqdm(total=len(csv_files), desc="Processing Matching CSV files") as pbar:
-                future_to_file = {executor.submit(self.convert_to_parquet, file): file for file in csv_files}
-
-                for future in concurrent.futures.as_completed(future_to_file):
-                    success, file_path, error, row_count = future.result()
-
-                    if success:
-                        success_count += 1
-                        total_rows += row_count
-                        logger.debug(f"Successfully processed {file_path}")
-                    else:
-                        logger.error(f"Failed to process {file_path}: {error}")
-                    
-                    pbar.update(1)
-
-        logger.success(f"Matching file processing complete: {success_count}/{len(csv_files)} files successfully processed")
-        logger.info(f"Total rows processed: {total_rows:,}")
-
-        return success_count, total_rows
+            parts = list(tqdm(executor.map(self.read_csv, range(len(csv_files)), csv_files),
+                              total=len(csv_files), desc="Reading Matching CSV files"))
+        total_rows = sum(rows for _, _, rows in parts)
+        logger.info(f"Total rows read: {total_rows:,}")
+
+        logger.info(f"Keeping the most recent record per {' / '.join(self.key_columns)}")
+        latest = self.latest_records(pl.concat([latest for latest, _, _ in parts]))
+        rows = write_parquet(latest.lazy().select(self.columns_to_keep), self.output_file)
+        history = (
+            self.link_history(pl.concat([history for _, history, _ in parts]))
+            .lazy()
+            .select(["DSCD", pl.col("_date").alias("date"), "WC06105"])
+            .sort(["DSCD", "date"], nulls_last=False)
+        )
+        history_rows = write_parquet(history, self.history_file)
+        self.remove_file_copies()
+        logger.success(f"Saved {rows} unique matching records to {self.output_file}")
+        logger.info(f"Saved {history_rows} link history records to {self.history_file}")
+
+        return len(csv_files), total_rows
 
 
 def main():
@@ -108,4 +164,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,139 @@
+from pathlib import Path
+
+import polars as pl
+from loguru import logger
+
+from out_of_core import write_parquet
+from security_master import LINK_COLUMNS
+
+
+class SecurityMasterBuilder:
+    """
+    Assigns dense integer keys to every Datastream code (ds_key) and every
+    Worldscope id (ws_key) the pipeline has seen, and stores the links of the
+    universal matching file in that key space:
+
+    ds_securities.parquet   ds_key, DSCode, GEOGC
+    ws_securities.parquet   ws_key, ws_id
+    links.parquet           ds_key, ws_key, valid_from, valid_to
+
+    The links are validity intervals built from the link history of step 04
+    (see security_master.py for their meaning and the as-of join).
+
+    Keys are UInt32, numbered in sorted order of the codes, so the same set of
+    codes always gets the same keys. Later steps join on the keys instead of the
+    string codes.
+    """
+
+    def __init__(self):
+        self.root_dir = Path(__file__).resolve().parents[1]
+        self.interim_dir = self.root_dir / "data" / "interim"
+        self.coverage_dir = self.interim_dir / "datastream" / "coverage"
+        self.ws_dir = self.interim_dir / "worldscope"
+        self.matching_file = self.interim_dir / "universal matching file" / "UniverseMatchingFile_consolidated.parquet"
+        self.history_file = self.interim_dir / "universal matching file" / "UniverseMatchingFile_history.parquet"
+        self.output_dir = self.interim_dir / "security_master"
+
+    @staticmethod
+    def _dense_keys(frames, column, key):
+        """`key` (0, 1, ...) for every distinct non-null value of `column` in `frames`."""
+        values = pl.concat([lf.select(pl.col(column).cast(pl.String)) for lf in frames])
+        return (
+            values.drop_nulls().unique().sort(column)
+            .with_row_index(key)
+        )
+
+    def _ds_codes(self, matching):
+        frames = [pl.scan_parquet(f).select("DSCode") for f in sorted(self.coverage_dir.glob("*.parquet"))]
+        frames.append(matching.select(pl.col("DSCD").alias("DSCode")))
+        logger.info(f"Collecting Datastream codes from {len(frames) - 1} coverage files and the matching file")
+        return frames
+
+    def _ws_ids(self, matching):
+        frames = []
+        for f in sorted(self.ws_dir.glob("*.parquet")):
+            lf = pl.scan_parquet(f)
+            if "ws_id" in lf.collect_schema().names():
+                frames.append(lf.select("ws_id"))
+        frames.append(matching.select(pl.col("WC06105").alias("ws_id")))
+        logger.info(f"Collecting Worldscope ids from {len(frames) - 1} Worldscope files and the matching file")
+        return frames
+
+    @staticmethod
+    def _link_intervals(history):
+        """
+        DSCD, WC06105, valid_from, valid_to from the link history: consecutive
+        records of a code with the same Worldscope id form one interval, which
+        ends where the next one starts. The first interval of a code reaches back
+        to the beginning; intervals without a Worldscope id are dropped.
+        """
+        new_interval = (
+            pl.col("DSCD").ne_missing(pl.col("DSCD").shift(1))
+            | pl.col("WC06105").ne_missing(pl.col("WC06105").shift(1))
+        )
+        return (
+            history.sort(["DSCD", "date"], nulls_last=False)
+            .with_columns(new_interval.cum_sum().alias("_interval"))
+            .group_by("_interval", maintain_order=True)
+            .agg(pl.col("DSCD").first(), pl.col("WC06105").first(), pl.col("date").first().alias("valid_from"))
+            .with_columns(
+                pl.when(pl.int_range(pl.len()).over("DSCD") > 0).then(pl.col("valid_from")).alias("valid_from"),
+                pl.col("valid_from").shift(-1).over("DSCD").alias("valid_to"),
+            )
+            .drop_nulls("WC06105")
+            .drop("_interval")
+        )
+
+    def build(self):
+        matching = pl.scan_parquet(self.matching_file).with_columns(
+            pl.col("DSCD").cast(pl.String), pl.col("WC06105").cast(pl.String)
+        )
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+        # Country of a security: the matching file is ordered most recent record first
+        countries = (
+            matching.select(pl.col("DSCD").alias("DSCode"), "GEOGC")
+            .drop_nulls()
+            .unique(subset="DSCode", keep="first", maintain_order=True)
+        )
+        ds_securities = (
+            self._dense_keys(self._ds_codes(matching), "DSCode", "ds_key")
+            .join(countries, on="DSCode", how="left", maintain_order="left")
+        )
+        ds_rows = write_parquet(ds_securities, self.output_dir / "ds_securities.parquet")
+        logger.info(f"{ds_rows} Datastream securities")
+
+        ws_securities = self._dense_keys(self._ws_ids(matching), "ws_id", "ws_key")
+        ws_rows = write_parquet(ws_securities, self.output_dir / "ws_securities.parquet")
+        logger.info(f"{ws_rows} Worldscope securities")
+
+        history = pl.scan_parquet(self.history_file).with_columns(
+            pl.col("DSCD").cast(pl.String), pl.col("WC06105").cast(pl.String)
+        )
+        links = (
+            self._link_intervals(history)
+            .join(pl.scan_parquet(self.output_dir / "ds_securities.parquet"), left_on="DSCD", right_on="DSCode")
+            .join(pl.scan_parquet(self.output_dir / "ws_securities.parquet"), left_on="WC06105", right_on="ws_id")
+            .select(LINK_COLUMNS)
+            .sort("ds_key", "valid_from", nulls_last=False)
+        )
+        link_rows = write_parquet(links, self.output_dir / "links.parquet")
+        logger.info(f"{link_rows} Datastream-Worldscope link intervals")
+
+    def run(self):
+        logger.info("Starting security master build")
+        try:
+            self.build()
+            logger.info(f"Security master written to {self.output_dir}")
+        except Exception as e:
+            logger.error(f"Unexpected error during processing: {str(e)}")
+            raise
+
+
+def main():
+    builder = SecurityMasterBuilder()
+    builder.run()
+
+
+if __name__ == "__main__":
+    main()
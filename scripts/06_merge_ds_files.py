@@ -1,142 +1,240 @@
+import glob
+import itertools
 import os
-from concurrent.futures import ThreadPoolExecutor
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 import pyarrow.parquet as pq
 from tqdm import tqdm
 
+from datastream_store import ARROW_PARTITIONING, MANIFEST, PARTITION_COLUMNS, VALUE_COLUMNS, write_manifest
+from resources import thread_budget
+from sorted_runs import aligned_chunks, sorted_runs
+
 
 class ParquetConsolidator:
-    def __init__(self, input_folder, chunk_size=100000, compression='snappy'):
+    """
+    Merges the market value and return files, in local currency and USD, of
+    each Datastream delivery into one wide row per security and date and
+    writes the result straight into the partitioned dataset described in
+    datastream_store.py (GEOGC / year). The files are merged as a stream of
+    sorted chunks, so a delivery needs about the same memory whatever its size
+    and several deliveries can be merged at once. Every delivery owns the
+    files named after it in the partitions, which are replaced when it is
+    merged and removed once it no longer exists. Whether the step runs is up
+    to the pipeline manifest, so every run merges all deliveries.
+    """
+
+    # Column of the merged panel each file type of step 02 fills
+    FILE_COLUMNS = {
+        'DailyReturnsLC': 'RI_LC',
+        'DailyReturnsUSD': 'RI_USD',
+        'DailyMVLC': 'MV_LC',
+        'DailyMVUSD': 'MV_USD',
+    }
+
+    # Rows read per batch from each sorted run, merged per chunk and per row group
+    BATCH_ROWS = 16 * 1024
+    CHUNK_ROWS = 256 * 1024
+    GROUP_ROWS = 64 * 1024
+
+    def __init__(self, input_folder, securities_file, compression='snappy'):
         self.input_folder = input_folder
-        self.chunk_size = chunk_size
+        self.securities_file = securities_file
         self.compression = compression
-        self.merged_folder = os.path.join(input_folder, 'merged')
-        os.makedirs(self.merged_folder, exist_ok=True)
+        self.output_folder = os.path.join(input_folder, 'Datastream_consolidated')
+        os.makedirs(self.output_folder, exist_ok=True)
 
-    def _merge_files(self, mv_file, returns_file, output_file):
-        try:
-            mv_table = pq.read_table(mv_file)
-            returns_table = pq.read_table(returns_file)
-            
-            merged = returns_table.join(
-                mv_table,
-                keys=['DSCode', 'Date', 'Currency'],
-                join_type="left outer"
-            )
-
-            pq.write_table(merged, output_file)
-            return output_file, merged.num_rows
-        except Exception as e:
-            return None, str(e)
-
-    def _append_files(self, input_files, output_file):
-        if not input_files:
-            raise ValueError("No input files provided")
-        
-        first_file = pq.ParquetFile(input_files[0])
-        schema = first_file.schema_arrow
-        
-        writer = None
-        total_row_groups = sum(pq.ParquetFile(f).num_row_groups for f in input_files)
-        
+    def _delivery_files(self, name):
+        """Files of merged delivery `name` in the partitioned dataset."""
+        pattern = os.path.join(glob.escape(self.output_folder), *['*'] * len(PARTITION_COLUMNS),
+                               f'{glob.escape(name)}-*.parquet')
+        return glob.glob(pattern)
+
+    def _securities(self):
+        """DSCode -> ds_key, GEOGC from the security master, sorted by DSCode."""
+        securities = pq.read_table(self.securities_file, columns=['DSCode', 'ds_key', 'GEOGC'])
+        securities = securities.filter(pc.is_valid(securities['DSCode'])).sort_by('DSCode')
+        return securities, securities['DSCode'].to_numpy(zero_copy_only=False)
+
+    def _merged_chunks(self, files, securities):
+        """
+        Merged rows of the files of one delivery ({value column: path}), one
+        key range of DSCodes at a time and sorted by ds_key, Date. All files
+        consist of runs sorted by DSCode, Date (see 02_process_ds.py), which
+        are merged batch by batch, so memory does not grow with the size of
+        the files.
+        """
+        securities, codes = securities
+        columns = list(files)
+        inputs = []
+        for path in files.values():
+            inputs.append((pq.read_schema(path), sorted_runs(path, ['DSCode', 'Date'], self.BATCH_ROWS)))
+        for tables in aligned_chunks(inputs, 'DSCode', self.CHUNK_ROWS):
+            # Step 02 only stores each series inside its own active range, so a date
+            # can have a market value but no return (or vice versa): keep all sides
+            merged = None
+            for column, table in zip(columns, tables):
+                table = table.select(['DSCode', 'Date', column.split('_')[0]]).rename_columns(['DSCode', 'Date', column])
+                merged = table if merged is None else merged.join(table, keys=['DSCode', 'Date'], join_type='full outer')
+            if merged.num_rows == 0:
+                continue
+            # Series without a file in this delivery stay empty
+            for column in VALUE_COLUMNS:
+                if column not in columns:
+                    merged = merged.append_column(column, pa.nulls(merged.num_rows, pa.float64()))
+            merged = merged.select(['DSCode', 'Date', *VALUE_COLUMNS])
+            # Only the securities of this key range take part in the join
+            chunk_codes = merged['DSCode']
+            first = codes.searchsorted(pc.min(chunk_codes).as_py(), side='left')
+            last = codes.searchsorted(pc.max(chunk_codes).as_py(), side='right')
+            merged = merged.join(securities.slice(first, last - first), keys='DSCode', join_type='left outer')
+            merged = merged.append_column('year', pc.year(merged['Date']).cast(pa.int32()))
+            # Keys follow the sort order of the codes, so this sorts by DSCode, Date
+            yield merged.sort_by([('ds_key', 'ascending'), ('Date', 'ascending')])
+
+    def _staging_folder(self, name):
+        """Folder delivery `name` is written to before its files replace the published ones."""
+        return os.path.join(self.output_folder, f'.{name}.tmp')
+
+    def _merge_files(self, files, name, securities):
+        """
+        Merges delivery `name` and returns its number of rows. The files are
+        written to a staging folder first and only moved into the partitions
+        once all of them are complete; on failure the staging folder is
+        removed and the published files of the delivery stay as they were.
+        """
+        staging = self._staging_folder(name)
+        shutil.rmtree(staging, ignore_errors=True)
         try:
-            with tqdm(total=total_row_groups, desc="Appending files", unit="row group") as pbar:
-                for file_path in input_files:
-                    parquet_file = pq.ParquetFile(file_path)
-                    
-                    if writer is None:
-                        writer = pq.ParquetWriter(output_file, schema)
-                    
-                    for row_group_idx in range(parquet_file.num_row_groups):
-                        row_group = parquet_file.read_row_group(row_group_idx)
-                        writer.write_table(row_group)
-                        pbar.update(1)
+            chunks = self._merged_chunks(files, securities)
+            first = next(chunks, None)
+            rows = 0
+            if first is not None:
+
+                def batches():
+                    nonlocal rows
+                    for chunk in itertools.chain([first], chunks):
+                        rows += chunk.num_rows
+                        yield from chunk.to_batches()
+
+                # The chunks arrive in code order, which the files of every partition keep
+                ds.write_dataset(
+                    batches(),
+                    staging,
+                    schema=first.schema,
+                    format='parquet',
+                    partitioning=ARROW_PARTITIONING,
+                    basename_template=f'{name}-{{i}}.parquet',
+                    max_partitions=100_000,
+                    preserve_order=True,
+                    min_rows_per_group=self.GROUP_ROWS,
+                    max_rows_per_group=self.GROUP_ROWS,
+                    file_options=ds.ParquetFileFormat().make_write_options(compression=self.compression),
+                )
+
+            # Publish: move the new files over the old ones, then drop the old files left over
+            published = set()
+            for path in glob.glob(os.path.join(glob.escape(staging), *['*'] * len(PARTITION_COLUMNS), '*.parquet')):
+                target = os.path.join(self.output_folder, os.path.relpath(path, staging))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(path, target)
+                published.add(target)
+            for f in self._delivery_files(name):
+                if f not in published:
+                    os.remove(f)
+            return rows
         finally:
-            if writer:
-                writer.close()
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def _remove_stale(self, names):
+        """
+        Removes the files of deliveries that no longer exist, the partitions
+        left empty, staging folders of interrupted runs and the per-currency
+        partitions of earlier versions.
+        """
+        for folder in glob.glob(os.path.join(glob.escape(self.output_folder), '.*.tmp')):
+            shutil.rmtree(folder)
+        for folder in glob.glob(os.path.join(glob.escape(self.output_folder), 'Currency=*')):
+            shutil.rmtree(folder)
+        for path in glob.glob(os.path.join(glob.escape(self.output_folder), *['*'] * len(PARTITION_COLUMNS), '*.parquet')):
+            if os.path.basename(path).rsplit('-', 1)[0] not in names:
+                os.remove(path)
+        for folder, subfolders, files in os.walk(self.output_folder, topdown=False):
+            if folder != self.output_folder and not os.listdir(folder):
+                os.rmdir(folder)
 
     def consolidate(self):
         """
-        Merges DailyMVUSD with DailyReturnsUSD, and DailyMVLC with DailyReturnsLC.
-        The resulting merged datasets are then appended into a single master file.
+        Merges the DailyReturnsLC, DailyReturnsUSD, DailyMVLC and DailyMVUSD
+        files of each delivery into one row per DSCode and Date, adds the
+        security's integer key (ds_key) and country (GEOGC) from the security
+        master and writes the merged rows into the GEOGC / year partitions of
+        Datastream_consolidated, followed by its manifest.
         """
         print(f"Starting consolidation process for: {self.input_folder}")
-        
+
         files = [f for f in os.listdir(self.input_folder) if f.endswith('.parquet')]
         print(f"Found {len(files)} parquet files")
-        
-        usd_files = {}
-        lc_files = {}
-        
-        for f in files:
-            if 'DailyMVUSD' in f:
-                suffix = f.replace('DailyMVUSD', '').replace('.parquet', '')
-                usd_files.setdefault(suffix, {})['mv'] = os.path.join(self.input_folder, f)
-            elif 'DailyReturnsUSD' in f:
-                suffix = f.replace('DailyReturnsUSD', '').replace('.parquet', '')
-                usd_files.setdefault(suffix, {})['returns'] = os.path.join(self.input_folder, f)
-            elif 'DailyMVLC' in f:
-                suffix = f.replace('DailyMVLC', '').replace('.parquet', '')
-                lc_files.setdefault(suffix, {})['mv'] = os.path.join(self.input_folder, f)
-            elif 'DailyReturnsLC' in f:
-                suffix = f.replace('DailyReturnsLC', '').replace('.parquet', '')
-                lc_files.setdefault(suffix, {})['returns'] = os.path.join(self.input_folder, f)
+
+        # Value column of every file type, e.g. DailyMVUSD_US_1.parquet -> MV_USD of delivery _US_1.
+        # The type tag may stand anywhere in the name; the rest of the name is the delivery.
+        deliveries = {}
+        for f in sorted(files):
+            for tag, column in self.FILE_COLUMNS.items():
+                if tag in f:
+                    suffix = f.replace(tag, '').replace('.parquet', '')
+                    deliveries.setdefault(suffix, {})[column] = os.path.join(self.input_folder, f)
+                    break
+            else:
+                print(f"Warning: no file type tag ({', '.join(self.FILE_COLUMNS)}) in {f}, not merged")
 
         print("Starting merge process")
-        merged_files = []
+        merged_names = set()
         merge_tasks = []
-        
-        for suffix, pair in usd_files.items():
-            if 'mv' in pair and 'returns' in pair:
-                output_file = os.path.join(self.merged_folder, f'MergedUSD{suffix}.parquet')
-                if os.path.exists(output_file):
-                    print(f"File exists, skipping: MergedUSD{suffix}.parquet")
-                    merged_files.append(output_file)
-                else:
-                    merge_tasks.append((pair['mv'], pair['returns'], output_file, f'MergedUSD{suffix}.parquet'))
-        
-        for suffix, pair in lc_files.items():
-            if 'mv' in pair and 'returns' in pair:
-                output_file = os.path.join(self.merged_folder, f'MergedLC{suffix}.parquet')
-                if os.path.exists(output_file):
-                    print(f"File exists, skipping: MergedLC{suffix}.parquet")
-                    merged_files.append(output_file)
-                else:
-                    merge_tasks.append((pair['mv'], pair['returns'], output_file, f'MergedLC{suffix}.parquet'))
-        
+
+        for suffix, delivery in deliveries.items():
+            name = f'Merged{suffix}'
+            merged_names.add(name)
+            merge_tasks.append((delivery, name))
+
         if merge_tasks:
-            max_threads = os.cpu_count()
+            securities = self._securities()
             with tqdm(total=len(merge_tasks), desc="Merging files", unit="file") as pbar:
-                with ThreadPoolExecutor(max_workers=max_threads) as executor:
-                    futures = []
-                    for mv_file, returns_file, output_file, file_name in merge_tasks:
-                        futures.append(executor.submit(self._merge_files, mv_file, returns_file, output_file))
-                    
-                    for future in futures:
-                        output_file, result = future.result()
-                        if output_file:
-                            merged_files.append(output_file)
-                            pbar.set_postfix({"Last merged": os.path.basename(output_file), "Rows": result})
-                        else:
-                            pbar.set_postfix({"Error": result})
+                with ThreadPoolExecutor(max_workers=thread_budget()) as executor:
+                    futures = {executor.submit(self._merge_files, delivery, name, securities): name
+                               for delivery, name in merge_tasks}
+                    failed = []
+                    for future in as_completed(futures):
+                        name = futures[future]
+                        try:
+                            pbar.set_postfix({"Last merged": name, "Rows": future.result()})
+                        except Exception as e:
+                            print(f"Error merging {name}: {e}")
+                            failed.append(name)
                         pbar.update(1)
+            if failed:
+                raise RuntimeError(f"Merging failed for: {', '.join(sorted(failed))}")
 
-        final_output = os.path.join(self.input_folder, 'Datastream_consolidated.parquet')
-        if os.path.exists(final_output):
-            print(f"Final output {final_output} already exists, skipping append")
-        elif merged_files:
-            print(f"Appending {len(merged_files)} files to create final output")
-            self._append_files(merged_files, final_output)
-        else:
-            print("No merged files to append")
-        
+        self._remove_stale(merged_names)
+        # Single-file copy of the panel written by earlier versions of this step
+        legacy_copy = self.output_folder + '.parquet'
+        if os.path.exists(legacy_copy):
+            os.remove(legacy_copy)
+        # The dataset is read in place: one manifest instead of a consolidated copy
+        file_count = write_manifest(self.output_folder)
+        print(f"Partitioned dataset written to: {self.output_folder} ({file_count} files in {MANIFEST})")
         print("Consolidation completed successfully")
 
 
 def main():
     input_folder = './data/interim/datastream'
-    consolidator = ParquetConsolidator(input_folder, chunk_size=100000, compression='snappy')
+    securities_file = './data/interim/security_master/ds_securities.parquet'
+    consolidator = ParquetConsolidator(input_folder, securities_file, compression='snappy')
     consolidator.consolidate()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,36 +1,45 @@
+import shutil
+
 import polars as pl
 from pathlib import Path
 
+from datastream_store import partitions, write_manifest
+from out_of_core import write_parquet
+from security_master import join_links_asof, scan_links
+
 def main():
     root_dir = Path(__file__).resolve().parents[1]  # your project root
-    ds_path = root_dir / "data" / "interim" / "datastream" / "Datastream_consolidated.parquet"
-    matching_path = root_dir / "data" / "interim" / "universal matching file" / "UniverseMatchingFile_consolidated.parquet"
-    
-    # Output in "data/processed" folder under your project
-    output_dir = root_dir / "data" / "processed"
-    output_dir.mkdir(parents=True, exist_ok=True)  # create if needed
-    output_file = output_dir / "Datastream_with_matching.parquet"
-
-    # 1) Read Datastream
-    ds = pl.read_parquet(ds_path)
-
-    # 2) Read matching
-    match_df = pl.read_parquet(matching_path)
-    # keep only relevant columns: DSCD, GEOGC, WC06105
-    match_df = match_df.select(["DSCD", "GEOGC", "WC06105"])
-
-    # 3) Join on DSCode == DSCD, left join
-    combined = ds.join(
-        match_df,
-        left_on="DSCode",
-        right_on="DSCD",
-        how="left"
+    ds_dir = root_dir / "data" / "interim" / "datastream" / "Datastream_consolidated"
+    master_dir = root_dir / "data" / "interim" / "security_master"
+
+    # Output in "data/processed" folder under your project, partitioned like the input
+    output_dir = root_dir / "data" / "processed" / "Datastream_with_matching"
+    shutil.rmtree(output_dir, ignore_errors=True)
+
+    # 1) Matching links in the integer key space with their validity intervals, with the
+    #    Worldscope id kept for readability; GEOGC is already a partition of the Datastream dataset
+    links = (
+        scan_links(master_dir).collect()
+        .join(pl.read_parquet(master_dir / "ws_securities.parquet"), on="ws_key", how="left")
+        .rename({"ws_id": "WC06105"})
+        .lazy()
     )
 
-    # 4) Write result
-    combined.write_parquet(output_file)
-    print(f"Joined file written to: {output_file}")
-    print(f"Result shape: {combined.shape}")
+    # 2) Attach the link valid on each date, partition by partition (one country/year
+    #    at a time, so memory is bounded by the largest partition); the as-of join keeps
+    #    exactly one row per Datastream row
+    rows = 0
+    ds_partitions = partitions(ds_dir)
+    for folder, _ in ds_partitions:
+        ds = pl.scan_parquet(folder / "*.parquet")
+        combined = join_links_asof(ds, links, on="Date")
+        target = output_dir / folder.relative_to(ds_dir)
+        target.mkdir(parents=True, exist_ok=True)
+        rows += write_parquet(combined, target / "part-0.parquet")
+    write_manifest(output_dir)
+
+    print(f"Joined dataset written to: {output_dir} ({len(ds_partitions)} partitions)")
+    print(f"Result rows: {rows}")
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,24 @@
 import polars as pl
 from pathlib import Path
 
+from out_of_core import collect, write_parquet
+from ws_ingestion import value_column
+
+
+def wide_items(lf, index, prefix):
+    """
+    One row per `index` key and one `{prefix}{item_code}` column per distinct
+    item code, holding the first value of that item from its typed value column
+    (see ws_ingestion.py). Equivalent to
+    group_by(...).agg(first) + pivot, but expressed as conditional aggregates so
+    it stays a lazy (streamable) query.
+    """
+    item_codes = sorted(collect(lf.select(pl.col("item_code").unique().drop_nulls())).to_series().to_list())
+    return lf.group_by(index).agg([
+        pl.col(value_column(code)).filter(pl.col("item_code") == code).first().alias(f"{prefix}{code}")
+        for code in item_codes
+    ])
+
 def main():
     # --------------------------------------------------------------------------
     # 1) Define paths
@@ -10,84 +28,62 @@ def main():
     main_file = root_dir / "data" / "interim" / "worldscope" / "WSFV_f_20250131.parquet"
     cal_file1 = root_dir / "data" / "interim" / "worldscope" / "WSCalendarPrd_f_20250131.parquet"
     cal_file2 = root_dir / "data" / "interim" / "worldscope" / "WSReportedPrd_f_20250131.parquet"
+    securities_file = root_dir / "data" / "interim" / "security_master" / "ws_securities.parquet"
 
     output_file = root_dir / "data" / "interim" / "Worldscope_clean" / "WSFV_merged_20250131.parquet"
     output_file.parent.mkdir(parents=True, exist_ok=True)
 
     # --------------------------------------------------------------------------
-    # 2) Read Main WSFV Data
+    # 2) Scan Main WSFV Data
     #    The main file has columns: [ws_id, point_date, freq, fiscal_period, item_code, value, ...]
+    #    The integer ws_key of the security master is added and used for all joins below.
     # --------------------------------------------------------------------------
-    main_df = pl.read_parquet(main_file)
+    securities = pl.read_parquet(securities_file).lazy()
+    main_df = pl.scan_parquet(main_file).join(securities, on="ws_id", how="left")
 
     # --------------------------------------------------------------------------
     # PART A: Process WSCalendarPrd_f_20250131
-    # Pivot by (ws_id, point_date, freq, fiscal_period) where each distinct item_code becomes a column.
+    # Widen by (ws_key, point_date, freq, fiscal_period) where each distinct item_code becomes a column
+    # with the prefix "cal1_".
     # --------------------------------------------------------------------------
-    cal1_df = pl.read_parquet(cal_file1)
-
-    # Aggregate to ensure one value per key (ws_id, point_date, freq, fiscal_period, item_code)
-    cal1_prep = cal1_df.group_by(["ws_id", "point_date", "freq", "fiscal_period", "item_code"]).agg(
-        pl.first("value").alias("value")
+    cal1_wide = wide_items(
+        pl.scan_parquet(cal_file1).join(securities, on="ws_id", how="left"),
+        index=["ws_key", "point_date", "freq", "fiscal_period"],
+        prefix="cal1_"
     )
-    # Pivot the aggregated data: each unique item_code becomes a column.
-    cal1_wide = cal1_prep.pivot(
-        index=["ws_id", "point_date", "freq", "fiscal_period"],
-        columns="item_code",
-        values="value"
-    )
-    # Rename pivoted columns to add the prefix "cal1_"
-    col_map = {}
-    for col in cal1_wide.columns:
-        if col not in ["ws_id", "point_date", "freq", "fiscal_period"]:
-            col_map[col] = f"cal1_{col}"
-    cal1_wide = cal1_wide.rename(col_map)
 
     # Join with the main DataFrame on the 4 key columns
     merged1 = main_df.join(
         cal1_wide,
-        left_on=["ws_id", "point_date", "freq", "fiscal_period"],
-        right_on=["ws_id", "point_date", "freq", "fiscal_period"],
+        left_on=["ws_key", "point_date", "freq", "fiscal_period"],
+        right_on=["ws_key", "point_date", "freq", "fiscal_period"],
         how="left"
     )
 
     # --------------------------------------------------------------------------
     # PART B: Process WSReportedPrd_f_20250131
-    # Pivot by (ws_id, point_date, freq) where each distinct item_code becomes a column.
+    # Widen by (ws_key, point_date, freq) with the prefix "cal2_".
     # --------------------------------------------------------------------------
-    cal2_df = pl.read_parquet(cal_file2)
-
-    # Aggregate to ensure one value per key (ws_id, point_date, freq, item_code)
-    cal2_prep = cal2_df.group_by(["ws_id", "point_date", "freq", "item_code"]).agg(
-        pl.first("value").alias("value")
-    )
-    # Pivot the aggregated data
-    cal2_wide = cal2_prep.pivot(
-        index=["ws_id", "point_date", "freq"],
-        columns="item_code",
-        values="value"
+    cal2_wide = wide_items(
+        pl.scan_parquet(cal_file2).join(securities, on="ws_id", how="left"),
+        index=["ws_key", "point_date", "freq"],
+        prefix="cal2_"
     )
-    # Rename pivoted columns to add the prefix "cal2_"
-    col_map2 = {}
-    for col in cal2_wide.columns:
-        if col not in ["ws_id", "point_date", "freq"]:
-            col_map2[col] = f"cal2_{col}"
-    cal2_wide = cal2_wide.rename(col_map2)
 
     # 2nd join on the keys for the reported period data.
     merged2 = merged1.join(
         cal2_wide,
-        left_on=["ws_id", "point_date", "freq"],
-        right_on=["ws_id", "point_date", "freq"],
+        left_on=["ws_key", "point_date", "freq"],
+        right_on=["ws_key", "point_date", "freq"],
         how="left"
     )
 
     # --------------------------------------------------------------------------
     # 4) Write final merged dataset
     # --------------------------------------------------------------------------
-    merged2.write_parquet(output_file)
+    rows = write_parquet(merged2, output_file)
     print(f"Done. Wrote merged file to: {output_file}")
-    print(f"Final shape: {merged2.shape}")
+    print(f"Final rows: {rows}")
 
 if __name__ == "__main__":
     main()
@@ -1,31 +1,40 @@
 import polars as pl
 from pathlib import Path
 
+from out_of_core import write_partitioned
+from worldscope_store import PARTITION_COLUMNS, ROW_GROUP_ROWS, SORT_COLUMNS, parquet_options
+
 def main():
     # Path to the original Parquet file
     input_file = Path("data/interim/Worldscope_clean/WSFV_merged_20250131_final.parquet")
     
-    # Define a name for the new Parquet file
-    output_file = input_file.parent / "WSFV_merged_20250131_final_no_cols.parquet"
+    # The cleaned items are written as a dataset partitioned by file type, freq
+    # and item code (see worldscope_store.py), so consumers read only their items
+    output_dir = Path("data/interim/Worldscope_clean_items")
     
-    # Read the original DataFrame
-    df = pl.read_parquet(input_file)
-    print(f"Original columns: {df.columns}")
+    # Scan the original DataFrame
+    df = pl.scan_parquet(input_file)
+    columns = df.collect_schema().names()
+    print(f"Original columns: {columns}")
     
     # Columns to drop
     cols_to_drop = ["cal1_57034", "cal1_55352", "cal1_55555", "cal2_55558"]
     
     # Only drop the columns that exist in the DataFrame
-    existing_cols_to_drop = [col for col in cols_to_drop if col in df.columns]
-    df_new = df.drop(existing_cols_to_drop)
+    existing_cols_to_drop = [col for col in cols_to_drop if col in columns]
+    df_new = df.drop(existing_cols_to_drop).with_columns(pl.lit("WSFV").alias("file_type"))
     
-    # Write the new DataFrame to a new Parquet file
-    df_new.write_parquet(output_file)
+    # Write the new DataFrame as the partitioned item store, sorted by company and
+    # date within each item so lookups of a few companies skip most row groups
+    df_new = df_new.sort(SORT_COLUMNS, maintain_order=True)
+    file_columns = [col for col in df_new.collect_schema().names() if col not in PARTITION_COLUMNS]
+    rows = write_partitioned(df_new, output_dir, PARTITION_COLUMNS,
+                             rows_per_group=ROW_GROUP_ROWS, **parquet_options(file_columns))
     
     # Print summary information
     print(f"Dropped columns: {existing_cols_to_drop}")
-    print(f"New file saved at: {output_file.resolve()}")
-    print(f"New columns: {df_new.columns}")
+    print(f"New dataset saved at: {output_dir.resolve()} ({rows} rows)")
+    print(f"New columns: {df_new.collect_schema().names()}")
 
 if __name__ == "__main__":
     main()
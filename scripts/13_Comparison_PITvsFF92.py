@@ -1,13 +1,11 @@
 # scripts/13_Comparison_PITvsFF92.py
 
-import os
-# Force Polars/Rayon to single-threaded mode
-os.environ["RAYON_NUM_THREADS"] = "1"
-os.environ["POLARS_MAX_THREADS"] = "1"
-
 import polars as pl
 from pathlib import Path
 
+from out_of_core import collect
+from worldscope_store import scan_items
+
 
 def year_bins_df() -> pl.DataFrame:
     """Build a lookup DataFrame mapping fiscal years to 5-year bins."""
@@ -34,20 +32,16 @@ def year_bins_df() -> pl.DataFrame:
 def main():
     # 1) Paths
     project_root = Path(__file__).resolve().parent.parent
-    in_file = project_root / "data" / "interim" / "Worldscope_clean" / "WSFV_merged_20250131_final_no_cols.parquet"
+    in_dir = project_root / "data" / "interim" / "Worldscope_clean_items"
     out_dir = project_root / "data" / "interim" / "Worldscope_clean_panels"
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    # 2) Load
-    df = pl.read_parquet(in_file)
+    # 2) Scan (only the two date columns are needed)
+    df = scan_items(in_dir).select(["cal1_55350", "point_date"])
 
-    # 3) Parse dates
+    # 3) Dates (cal1_55350 is a date since step 3)
     df = df.with_columns([
-        pl.col("cal1_55350")
-          .str.replace_all('"', '')
-          .str.replace(r"^d", "")
-          .str.strptime(pl.Date, format="%Y%m%d")
-          .alias("fye_date"),
+        pl.col("cal1_55350").alias("fye_date"),
         pl.col("point_date").dt.date().alias("pit_date"),
     ])
 
@@ -65,10 +59,10 @@ def main():
 
     # 6) Join on 5-year bins
     bins_df = year_bins_df()
-    df = df.join(bins_df, on="fye_year", how="left")
+    df = df.join(bins_df.lazy(), on="fye_year", how="left")
 
     # 7) Panel A: PIT → FYE distribution
-    panel_a = (
+    panel_a = collect(
         df.group_by("fye_bin").agg([
             pl.mean("diff_to_fye").round(1).alias("Mean"),
             pl.median("diff_to_fye").alias("Median"),
@@ -80,7 +74,7 @@ def main():
     panel_a.write_csv(out_dir / "panel_A_diff_pit_to_fye.csv")
 
     # 8) Panel B: PIT → FF92 distribution
-    panel_b = (
+    panel_b = collect(
         df.group_by("fye_bin").agg([
             pl.mean("diff_to_ff92").round(1).alias("Mean"),
             pl.median("diff_to_ff92").alias("Median"),
@@ -92,18 +86,18 @@ def main():
     panel_b.write_csv(out_dir / "panel_B_diff_pit_to_ff92.csv")
 
         # 9) Panel C: FF92 availability at rebalancing
-    total      = pl.count().alias("N")
+    total      = pl.len().alias("N")
     late_count = (pl.col("diff_to_ff92").gt(0).cast(pl.Int64).sum().alias("FF92_not_available"))
     avail_count= (pl.col("diff_to_ff92").le(0).cast(pl.Int64).sum().alias("Data_available_by_FF92"))
     pct_late   = (late_count / total * 100).round(1).alias("Pct_FF92_not_avail")
     pct_avail  = (avail_count / total * 100).round(1).alias("Pct_data_avail_by_FF92")
 
-    panel_c = (
+    panel_c = collect(
         df.group_by("fye_bin").agg([total, late_count, pct_late, avail_count, pct_avail]).sort("fye_bin")
     )
     panel_c.write_csv(out_dir / "panel_C_availability_at_FF92.csv")
 
-    print("Panels written to:", out_dir.resolve())("Panels written to:", out_dir.resolve())
+    print("Panels written to:", out_dir.resolve())
 
 if __name__ == "__main__":
     main()
@@ -1,9 +1,10 @@
 # scripts/14_PIT_vs_FF92_filter.py
 
-import os
 from pathlib import Path
 import polars as pl
 
+from worldscope_store import scan_items
+
 # Lookup table for 5-year bins
 def make_year_bins() -> pl.DataFrame:
     years = list(range(1970, 2030))
@@ -27,26 +28,18 @@ def make_year_bins() -> pl.DataFrame:
 
 
 def main():
-    # force single-thread for stability
-    os.environ["RAYON_NUM_THREADS"] = "1"
-    os.environ["POLARS_MAX_THREADS"] = "1"
-
     # Paths
     project_root = Path(__file__).resolve().parent.parent
-    in_file = project_root / "data" / "interim" / "Worldscope_clean" / "WSFV_merged_20250131_final_no_cols.parquet"
+    in_dir = project_root / "data" / "interim" / "Worldscope_clean_items"
     out_dir = project_root / "data" / "interim" / "Worldscope_clean_panels"
     out_dir.mkdir(parents=True, exist_ok=True)
 
     # Read base data
-    df = pl.read_parquet(in_file)
+    df = scan_items(in_dir).collect()
 
-    # Parse dates
+    # Dates (cal1_55350 is a date since step 3)
     df = df.with_columns([
-        pl.col("cal1_55350")
-          .str.replace_all('"', '')
-          .str.replace(r"^d", "")
-          .str.strptime(pl.Date, format="%Y%m%d")
-          .alias("fye_date"),
+        pl.col("cal1_55350").alias("fye_date"),
         pl.col("point_date").dt.date().alias("pit_date"),
     ])
 
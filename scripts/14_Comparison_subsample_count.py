@@ -1,26 +1,19 @@
-import os
 import polars as pl
 from pathlib import Path
 
-def main():
-    # Force Polars/Rayon to single-thread
-    os.environ["RAYON_NUM_THREADS"] = "1"
-    os.environ["POLARS_MAX_THREADS"] = "1"
+from worldscope_store import scan_items
 
+def main():
     # Paths
     project_root = Path(__file__).resolve().parent.parent
-    input_file = project_root / "data" / "interim" / "Worldscope_clean" / "WSFV_merged_20250131_final_no_cols.parquet"
+    input_dir = project_root / "data" / "interim" / "Worldscope_clean_items"
 
     # Read data
-    df = pl.read_parquet(input_file)
+    df = scan_items(input_dir).collect()
 
-    # Parse fiscal-year-end date and PIT release date
+    # Fiscal-year-end date (a date since step 3) and PIT release date
     df = df.with_columns([
-        pl.col("cal1_55350")
-          .str.replace_all('"', '')
-          .str.replace(r"^d", "")
-          .str.strptime(pl.Date, format="%Y%m%d")
-          .alias("fye_date"),
+        pl.col("cal1_55350").alias("fye_date"),
         pl.col("point_date").dt.date().alias("pit_date"),
     ])
 
@@ -4,46 +4,15 @@ Compute 28 accounting anomalies automatically by looping over a config dict.
 Reads only needed Worldscope item tables, pivots via joins, evaluates each anomaly formula,
 and writes a wide anomalies table.
 """
-import os
 from pathlib import Path
 import polars as pl
 
-# Force single-threaded to avoid pool issues
-os.environ["RAYON_NUM_THREADS"] = "1"
-os.environ["POLARS_MAX_THREADS"] = "1"
+from anomaly_config import ANOMALIES, COLUMN_MAP
+from worldscope_store import available_item_codes, scan_items
 
 # ----------------------------------------------------------------------------
-# 1) Define anomaly configurations: mapping name -> inputs + formula
+# 1) Anomaly configurations (name -> inputs + formula) live in anomaly_config.py
 # ----------------------------------------------------------------------------
-COLUMN_MAP = {
-    5490: 'BE',    # Book Equity
-    2003: 'Cash',  # Cash
-    1051: 'COGS',  # COGS
-    2201: 'CA',    # Current Assets
-    3101: 'CL',    # Current Liabilities
-    9502: 'DivP',  # Dividend Payout
-    5255: 'EPS',   # Earnings per Share
-    8698: 'SGx',   # Sales Growth - Expected Growth
-    2649: 'Intan', # Intangible Assets
-    2101: 'Inv',   # Inventory
-    18199: 'NDebt',# Net Debt
-    6895: 'NI',    # Net Income
-    6620: 'PPE',   # Property, Plant & Equipment
-    1401: 'PreTax',# Pre-Tax Income
-    5006: 'Price', # Market Price
-    7240: 'Sales', # Net Sales
-    1101: 'SGA',   # SG&A
-    3051: 'STD',   # Short-Term Debt
-    1451: 'Tax',   # Tax Expense
-    6699: 'TA',    # Total Assets
-    3351: 'TL',    # Total Liabilities
-}
-
-# Define ANOMALIES dict with 'inputs' and 'formula' keys
-ANOMALIES = {
-    # 'Acc': {'inputs': [2201,3101,2003,3051], 'formula': '(CA - CL - Cash + STD) / TA'},
-    # ... other anomalies ...
-}
 
 # ----------------------------------------------------------------------------
 # 2) Paths
@@ -58,42 +27,39 @@ OUTPUT_PATH = ROOT / 'data' / 'processed' / 'anomalies_worldscope.parquet'
 def main():
     # Gather codes needed from anomaly definitions
     all_codes = sorted({c for cfg in ANOMALIES.values() for c in cfg['inputs']})
+    stored = set(available_item_codes(WS_DIR))
     available = []
     for code in all_codes:
-        path = WS_DIR / f'WS_item_{code}.parquet'
         col = COLUMN_MAP.get(code, f'item_{code}')
-        if path.exists():
-            available.append((code, col, path))
+        if code in stored:
+            available.append((code, col))
         else:
-            print(f"⚠️ missing WS_item_{code}.parquet, skipping code {code}")
+            print(f"⚠️ missing item_code={code} in {WS_DIR.name}, skipping code {code}")
 
     if not available:
-        print("❌ No WS item files found. Cannot compute anomalies without inputs.")
+        print("❌ No WS items found. Cannot compute anomalies without inputs.")
         return
 
-    # Build through individual item files
+    # Build through the item partitions (only the partitions of the needed items are read)
+    # Items are joined on the integer ws_key; ws_id is carried along from the first item only
     lf = None
-    for code, col, path in available:
+    for code, col in available:
         part = (
-            pl.scan_parquet(path)
-              .select([
-                  'ws_id', 'point_date', 'freq', 'fiscal_period', 'cal1_55350',
-                  pl.col('value').str.replace_all('"','').cast(pl.Float64).alias(col)
+            scan_items(WS_DIR, item_codes=[code])
+              .select(([] if lf is not None else ['ws_id']) + [
+                  'ws_key', 'point_date', 'freq', 'fiscal_period', 'cal1_55350',
+                  pl.col('value').alias(col)
               ])
         )
         lf = part if lf is None else lf.join(
             part,
-            on=['ws_id','point_date','freq','fiscal_period','cal1_55350'],
+            on=['ws_key','point_date','freq','fiscal_period','cal1_55350'],
             how='inner'
         )
 
-    # Parse dates and compute FF92 date
+    # Dates (cal1_55350 is a date since step 3) and FF92 date
     lf = lf.with_columns([
-        pl.col('cal1_55350')
-          .str.replace_all('"','')
-          .str.replace(r'^d','')
-          .str.strptime(pl.Date, format='%Y%m%d')
-          .alias('fye_date'),
+        pl.col('cal1_55350').alias('fye_date'),
         pl.col('point_date').dt.date().alias('pit_date')
     ])
     lf = lf.with_columns([
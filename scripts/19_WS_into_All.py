@@ -1,26 +1,37 @@
 import polars as pl
 from pathlib import Path
 
+from datastream_store import scan_datastream
+from out_of_core import write_parquet
+from worldscope_store import scan_items
+
+# Restrict the Datastream panel to some countries and years, e.g. YEARS = (1990, 2024)
+# (only the matching partition folders are read), and to the columns of some
+# CURRENCIES, e.g. ["USD"]
+CURRENCIES = None
+COUNTRIES = None
+YEARS = None
+
 def main():
     root_dir = Path(__file__).resolve().parents[1]
     
-    # 1) Path to the Datastream file containing 'WC06105'
-    ds_file = root_dir / "data" / "processed" / "Datastream_with_matching.parquet"
+    # 1) Path to the Datastream dataset containing 'WC06105'
+    ds_dir = root_dir / "data" / "processed" / "Datastream_with_matching"
     
-    # 2) Path to the worldscope item=2003 file
-    ws_file = root_dir / "data" / "interim" / "worldscope_items" / "WS_item_2003.parquet"
+    # 2) Path to the partitioned worldscope items (only item 2003 is read)
+    ws_dir = root_dir / "data" / "interim" / "Worldscope_clean_items"
     
     # 3) Output path
     output_file = root_dir / "data" / "processed" / "DS_with_WS2003.parquet"
     output_file.parent.mkdir(parents=True, exist_ok=True)
     
-    # 4) Read the Datastream data
-    ds = pl.read_parquet(ds_file)
-    # ds should have columns like: ["DSCode", "Date", "RI", "Currency", "MV", "GEOGC", "WC06105", ...]
+    # 4) Scan the Datastream data
+    ds = scan_datastream(ds_dir, currencies=CURRENCIES, countries=COUNTRIES, years=YEARS)
+    # ds should have columns like: ["DSCode", "Date", "RI_LC", "RI_USD", "MV_LC", "MV_USD", "ds_key", "ws_key", "WC06105", "GEOGC", "year"]
 
-    # 5) Read the worldscope file for item_code=2003
-    ws = pl.read_parquet(ws_file)
-    # ws has columns like: ["ws_id", "point_date", "freq", "fiscal_period", "item_code", "value"]
+    # 5) Scan the worldscope items for item_code=2003
+    ws = scan_items(ws_dir, item_codes=[2003])
+    # ws has columns like: ["ws_id", "ws_key", "point_date", "freq", "fiscal_period", "item_code", "value"]
 
     # 6) Convert the worldscope "point_date" from datetime to date
     #    That way it matches Datastream's "Date" (which is typically pl.Date)
@@ -31,11 +42,11 @@ def main():
     # (Optional) rename "value" to something more descriptive before the join
     # Or we can rename after. We’ll do it after so we can see the original name first.
 
-    # 7) Join on WC06105==ws_id AND Date==point_date
+    # 7) Join on the security master's ws_key AND Date==point_date
     merged = ds.join(
-        ws.select(["ws_id", "point_date", "value"]),  # only these columns needed for the join
-        left_on=["WC06105", "Date"],
-        right_on=["ws_id", "point_date"],
+        ws.select(["ws_key", "point_date", "value"]),  # only these columns needed for the join
+        left_on=["ws_key", "Date"],
+        right_on=["ws_key", "point_date"],
         how="left"
     )
 
@@ -43,10 +54,10 @@ def main():
     merged = merged.rename({"value": "WS2003_PIT"})
 
     # 9) Write out the final dataset
-    merged.write_parquet(output_file)
+    rows = write_parquet(merged, output_file)
     
     print(f"Merged file written to: {output_file}")
-    print(f"Result shape: {merged.shape}")
+    print(f"Result rows: {rows}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,39 @@
+"""
+Anomaly definitions: the Worldscope items the anomalies use and their formulas.
+
+COLUMN_MAP  item code -> column name in the formulas
+ANOMALIES   anomaly name -> {'inputs': item codes, 'formula': expression}
+
+Step 15 computes the anomalies from these definitions; step 03 converts only
+the items they use (see ws_ingestion.py).
+"""
+
+COLUMN_MAP = {
+    5490: 'BE',    # Book Equity
+    2003: 'Cash',  # Cash
+    1051: 'COGS',  # COGS
+    2201: 'CA',    # Current Assets
+    3101: 'CL',    # Current Liabilities
+    9502: 'DivP',  # Dividend Payout
+    5255: 'EPS',   # Earnings per Share
+    8698: 'SGx',   # Sales Growth - Expected Growth
+    2649: 'Intan', # Intangible Assets
+    2101: 'Inv',   # Inventory
+    18199: 'NDebt',# Net Debt
+    6895: 'NI',    # Net Income
+    6620: 'PPE',   # Property, Plant & Equipment
+    1401: 'PreTax',# Pre-Tax Income
+    5006: 'Price', # Market Price
+    7240: 'Sales', # Net Sales
+    1101: 'SGA',   # SG&A
+    3051: 'STD',   # Short-Term Debt
+    1451: 'Tax',   # Tax Expense
+    6699: 'TA',    # Total Assets
+    3351: 'TL',    # Total Liabilities
+}
+
+# Define ANOMALIES dict with 'inputs' and 'formula' keys
+ANOMALIES = {
+    # 'Acc': {'inputs': [2201,3101,2003,3051], 'formula': '(CA - CL - Cash + STD) / TA'},
+    # ... other anomalies ...
+}
@@ -0,0 +1,127 @@
+"""
+Layout of the Datastream panel on disk.
+
+Step 06 writes the merged daily panel as a hive-partitioned dataset
+
+    data/interim/datastream/Datastream_consolidated/GEOGC=US/year=2020/<delivery>-0.parquet
+
+and step 07 writes Datastream_with_matching in the same layout. Every security
+and date is one row with the return index and market value in both currencies
+(VALUE_COLUMNS: RI_LC, RI_USD, MV_LC, MV_USD), so the key is stored once for
+all four series. The partition values are not stored in the files; they are
+read back from the paths, so a query that filters on GEOGC or year only opens
+the matching folders. Securities without a country are stored under GEOGC=__HIVE_DEFAULT_PARTITION__
+and read back as null.
+
+Both steps also write a manifest, <dataset>/_metadata, with the footers of all
+files of the dataset. Arrow-based readers (`open_dataset`, Dask, DuckDB) see
+the dataset as one table without listing the folders or opening every file.
+The files are never copied into one; `compact` does that when a single file is
+explicitly needed.
+"""
+import os
+from pathlib import Path
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+PARTITION_COLUMNS = ["GEOGC", "year"]
+HIVE_SCHEMA = {"GEOGC": pl.String, "year": pl.Int32}
+CURRENCIES = ["LC", "USD"]
+VALUE_COLUMNS = [f"{item}_{currency}" for item in ("RI", "MV") for currency in CURRENCIES]
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+MANIFEST = "_metadata"
+ARROW_PARTITIONING = ds.partitioning(
+    pa.schema([("GEOGC", pa.string()), ("year", pa.int32())]),
+    flavor="hive",
+)
+
+
+def scan_datastream(path, currencies=None, countries=None, years=None):
+    """
+    LazyFrame over a partitioned Datastream dataset, restricted to the given
+    GEOGC codes and (first, last) year range. `currencies` ("USD"/"LC") keeps
+    only the value columns of those currencies.
+    """
+    # The glob skips the manifest, which Polars would otherwise take for a data file
+    lf = pl.scan_parquet(Path(path) / "**" / "*.parquet", hive_partitioning=True, hive_schema=HIVE_SCHEMA)
+    if currencies is not None:
+        dropped = [c for c in VALUE_COLUMNS if c.rsplit("_", 1)[1] not in currencies]
+        lf = lf.drop(dropped)
+    if countries is not None:
+        lf = lf.filter(pl.col("GEOGC").is_in(list(countries)))
+    if years is not None:
+        first, last = years
+        lf = lf.filter(pl.col("year").is_between(first, last))
+    return lf
+
+
+def partitions(path):
+    """(folder, {column: value}) for every partition of the dataset at `path`."""
+    result = []
+    for folder in sorted(Path(path).glob("/".join(f"{col}=*" for col in PARTITION_COLUMNS))):
+        values = dict(part.split("=", 1) for part in folder.relative_to(path).parts)
+        values = {col: None if value == NULL_PARTITION else value for col, value in values.items()}
+        values["year"] = int(values["year"])
+        result.append((folder, values))
+    return result
+
+
+def data_files(path):
+    """Parquet files of the dataset at `path`, relative to it."""
+    path = Path(path)
+    pattern = "/".join(["*"] * len(PARTITION_COLUMNS) + ["*.parquet"])
+    return sorted(f.relative_to(path).as_posix() for f in path.glob(pattern))
+
+
+def write_manifest(path):
+    """
+    Writes the manifest of the dataset at `path` from the footers of its files
+    (nothing but the footers is read); returns the number of files. The files
+    must share one schema.
+    """
+    path = Path(path)
+    manifest = path / MANIFEST
+    files = data_files(path)
+    if not files:
+        manifest.unlink(missing_ok=True)
+        return 0
+    footers = []
+    for name in files:
+        footer = pq.read_metadata(path / name)
+        footer.set_file_path(name)
+        footers.append(footer)
+    tmp = manifest.with_name(MANIFEST + ".tmp")
+    pq.write_metadata(pq.read_schema(path / files[0]), tmp, metadata_collector=footers)
+    os.replace(tmp, manifest)
+    return len(files)
+
+
+def open_dataset(path):
+    """
+    Arrow dataset over the dataset at `path`, from its manifest if there is
+    one, else by listing the files. The partition columns come from the paths.
+    """
+    path = Path(path)
+    if (path / MANIFEST).exists():
+        return ds.parquet_dataset(path / MANIFEST, partitioning=ARROW_PARTITIONING)
+    return ds.dataset(path, format="parquet", partitioning=ARROW_PARTITIONING)
+
+
+def compact(path, output_file, compression="zstd"):
+    """
+    Copies the dataset at `path`, partition columns included, into the single
+    parquet file `output_file`, batch by batch; returns the number of rows.
+    Only for consumers that need one file, the pipeline itself never does this.
+    """
+    dataset = open_dataset(path)
+    rows = 0
+    tmp = Path(output_file).with_suffix(".parquet.tmp")
+    with pq.ParquetWriter(tmp, dataset.schema, compression=compression) as writer:
+        for batch in dataset.to_batches():
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    os.replace(tmp, output_file)
+    return rows
@@ -0,0 +1,75 @@
+"""
+Out-of-core execution for the Polars steps.
+
+The steps build their queries as LazyFrames on `scan_parquet` and hand them to
+`collect`/`write_parquet` below. With PIPELINE_OUT_OF_CORE=1 (set by
+`run_pipeline.py --out-of-core`) the queries run on the streaming engine and
+results are written with `sink_parquet`, so the data is processed in batches
+and never held in memory as a whole. Otherwise the query is collected in memory
+and written as before.
+"""
+import os
+import shutil
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+
+def out_of_core():
+    return os.environ.get("PIPELINE_OUT_OF_CORE") == "1"
+
+
+def row_count(path):
+    """Number of rows of a parquet file, from its footer."""
+    return pl.scan_parquet(path).select(pl.len()).collect().item()
+
+
+def collect(lf):
+    """Collect a (small) result, on the streaming engine in out-of-core mode."""
+    return lf.collect(engine="streaming" if out_of_core() else "auto")
+
+
+def write_parquet(lf, path):
+    """Write the result of a query to `path`; returns the number of rows written."""
+    if out_of_core():
+        lf.sink_parquet(path)
+        return row_count(path)
+    df = lf.collect()
+    df.write_parquet(path)
+    return df.height
+
+
+def write_partitioned(lf, path, partition_by, rows_per_group=None, **parquet_options):
+    """
+    Write the result of a query as a hive-partitioned dataset below `path`
+    (replacing what is there); returns the number of rows written. The rows keep
+    their order within each partition; `parquet_options` are passed to Arrow's
+    parquet writer, `rows_per_group` fixes the row group size.
+    """
+    shutil.rmtree(path, ignore_errors=True)
+    schema = pa.schema(lf.clear().collect().to_arrow().schema)
+    rows = 0
+
+    def batches():
+        nonlocal rows
+        if not out_of_core():
+            df = lf.collect()
+            rows = df.height
+            yield from df.to_arrow().cast(schema).to_batches()
+            return
+        # Batches from the streaming engine, split into the partitions by Arrow
+        for df in lf.collect_batches(engine="streaming"):
+            rows += df.height
+            yield from df.to_arrow().cast(schema).to_batches()
+
+    ds.write_dataset(
+        batches(), path, schema=schema, format="parquet",
+        partitioning=partition_by, partitioning_flavor="hive",
+        basename_template="part-{i}.parquet", max_partitions=1_000_000,
+        preserve_order=True,
+        file_options=ds.ParquetFileFormat().make_write_options(**parquet_options),
+        min_rows_per_group=rows_per_group or 0,
+        max_rows_per_group=rows_per_group or 1024 * 1024,
+    )
+    return rows
@@ -0,0 +1,357 @@
+"""
+Access to the raw input files, either from the folder extracted by step 01 or
+straight from `Anomaly Publication.zip` without extracting anything to disk.
+
+Zip members are addressed by the path they would have after extraction (nested
+zips are extracted into their own folder by step 01), so the processors keep
+working with the same folder names and file stems in both modes.
+
+The mode is chosen with the PIPELINE_RAW_SOURCE environment variable:
+"dir" (extracted files), "zip" (stream from the archive) or "auto" (default,
+uses the extracted folder if it exists, the archive otherwise).
+
+With PIPELINE_CHANGED_RAW_ONLY=1 the processors only convert the files that
+changed since they last converted them (see ConvertedRawFiles).
+"""
+import atexit
+import fnmatch
+import hashlib
+import io
+import json
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import zipfile
+from pathlib import Path, PurePosixPath
+
+from loguru import logger
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+RAW_DATA_DIR = ROOT_DIR / "data" / "raw"
+ZIP_FILE_PATH = RAW_DATA_DIR / "Anomaly Publication.zip"
+PUBLICATION_DIR = RAW_DATA_DIR / "Anomaly Publication"
+
+# Written by step 01: CRC/size of every extracted file and a report of the changes of its last run
+EXTRACT_STATE_PATH = RAW_DATA_DIR / ".extract_state.json"
+EXTRACT_DELTA_PATH = RAW_DATA_DIR / ".extract_delta.json"
+
+# Deflated nested zips are not seekable in place; they are copied (compressed)
+# once into a spool folder and reused for every member read. The folder is made
+# by the step's main process, passed to its worker processes through the
+# environment (so they reuse or add to it) and removed when the main process exits.
+SPOOL_DIR_VARIABLE = "PIPELINE_RAW_SPOOL_DIR"
+_spool_lock = threading.Lock()
+
+
+def _spool_dir():
+    path = os.environ.get(SPOOL_DIR_VARIABLE)
+    if path is None or not os.path.isdir(path):
+        path = tempfile.mkdtemp(prefix="raw_spool_")
+        os.environ[SPOOL_DIR_VARIABLE] = path
+        owner = os.getpid()
+        # Forked children inherit the handler; only the owner removes the folder
+        atexit.register(lambda: os.getpid() == owner and shutil.rmtree(path, ignore_errors=True))
+    return path
+
+
+def raw_source_mode():
+    mode = os.environ.get("PIPELINE_RAW_SOURCE", "auto").lower()
+    if mode == "auto":
+        return "dir" if PUBLICATION_DIR.exists() else "zip"
+    if mode not in ("dir", "zip"):
+        raise ValueError(f"Unknown PIPELINE_RAW_SOURCE: {mode}")
+    return mode
+
+
+def _is_zip(name):
+    return name.lower().endswith(".zip")
+
+
+class _SliceFile(io.RawIOBase):
+    """Read-only, seekable window [start, start + length) of a file on disk."""
+
+    def __init__(self, path, start, length):
+        self._file = open(path, "rb")
+        self._start = start
+        self._length = length
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self._length + offset
+        self._pos = max(0, min(self._pos, self._length))
+        return self._pos
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self._length - self._pos)
+        if size <= 0:
+            return 0
+        self._file.seek(self._start + self._pos)
+        read = self._file.readinto(memoryview(buffer)[:size])
+        self._pos += read
+        return read
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def _member_data_offset(archive_path, info):
+    """Offset of a member's (stored) data inside the archive file."""
+    with open(archive_path, "rb") as f:
+        f.seek(info.header_offset)
+        header = f.read(30)
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    return info.header_offset + 30 + name_length + extra_length
+
+
+class _OwnedZipFile(zipfile.ZipFile):
+    """ZipFile that also closes the file object it was opened on."""
+
+    def __init__(self, fileobj):
+        self._owned_file = fileobj
+        super().__init__(fileobj)
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._owned_file.close()
+
+
+def _open_nested_zip(archive_path, member):
+    """
+    Open a zip that is itself a member of `archive_path`. Stored members are
+    read in place through a file window, compressed ones from a spooled copy.
+    """
+    with zipfile.ZipFile(archive_path) as outer:
+        info = outer.getinfo(member)
+        if info.compress_type == zipfile.ZIP_STORED:
+            offset = _member_data_offset(archive_path, info)
+            return _OwnedZipFile(io.BufferedReader(_SliceFile(archive_path, offset, info.file_size)))
+
+        name = hashlib.blake2b(f"{archive_path}|{member}|{info.CRC}".encode(), digest_size=16).hexdigest()
+        with _spool_lock:
+            spool_path = os.path.join(_spool_dir(), f"{name}.zip")
+            if not os.path.exists(spool_path):
+                logger.debug(f"Nested archive {member} is compressed, spooling it to a temporary file")
+                # Written under a private name first, so processes spooling at once do not clash
+                tmp_path = f"{spool_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as spool, outer.open(info) as src:
+                    shutil.copyfileobj(src, spool, 8 * 1024 * 1024)
+                os.replace(tmp_path, spool_path)
+        return _OwnedZipFile(open(spool_path, "rb"))
+
+
+class _MemberReader(io.BufferedReader):
+    """Member stream that also closes the archives it was opened from."""
+
+    def __init__(self, raw, archives):
+        super().__init__(raw, buffer_size=8 * 1024 * 1024)
+        self._archives = archives
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            for archive in reversed(self._archives):
+                archive.close()
+
+
+class RawFile:
+    """
+    A raw input file, on disk or inside the publication zip. Behaves like the
+    Path it would have after extraction (name, stem, parent, str) and can be
+    pickled to worker processes.
+    """
+
+    def __init__(self, path, members=(), size=None):
+        self.path = Path(path)
+        self.members = tuple(members)
+        self._size = size
+
+    @property
+    def name(self):
+        return self.path.name
+
+    @property
+    def stem(self):
+        return self.path.stem
+
+    @property
+    def parent(self):
+        return self.path.parent
+
+    @property
+    def in_archive(self):
+        return bool(self.members)
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = self.path.stat().st_size
+        return self._size
+
+    def __str__(self):
+        return str(self.path)
+
+    def __fspath__(self):
+        if self.in_archive:
+            raise TypeError(f"{self.path} is read from {ZIP_FILE_PATH.name}; use RawFile.open()")
+        return str(self.path)
+
+    def __repr__(self):
+        return f"RawFile({str(self.path)!r}, members={self.members!r})"
+
+    def open(self):
+        """Binary, buffered file object. Use as a context manager."""
+        if not self.in_archive:
+            return open(self.path, "rb")
+
+        archives = []
+        try:
+            if len(self.members) == 1:
+                archive = zipfile.ZipFile(ZIP_FILE_PATH)
+            else:
+                archive = _open_nested_zip(ZIP_FILE_PATH, self.members[0])
+            archives.append(archive)
+            return _MemberReader(archive.open(self.members[-1]), archives)
+        except Exception:
+            for archive in archives:
+                archive.close()
+            raise
+
+
+def _iter_archive_files():
+    """All files in the publication zip, nested zips expanded one level deep."""
+    with zipfile.ZipFile(ZIP_FILE_PATH) as outer:
+        for info in outer.infolist():
+            if info.is_dir():
+                continue
+            if not _is_zip(info.filename):
+                yield RawFile(RAW_DATA_DIR / info.filename, (info.filename,), info.file_size)
+                continue
+            extract_dir = RAW_DATA_DIR / PurePosixPath(info.filename).parent
+            with _open_nested_zip(ZIP_FILE_PATH, info.filename) as nested:
+                for nested_info in nested.infolist():
+                    if not nested_info.is_dir():
+                        yield RawFile(extract_dir / nested_info.filename,
+                                      (info.filename, nested_info.filename), nested_info.file_size)
+
+
+def list_raw_files(folder, pattern, recursive=True):
+    """
+    Raw files below `folder` (a path under data/raw) whose name matches `pattern`,
+    from the extracted folder or the archive depending on the raw source mode.
+    """
+    folder = Path(folder)
+    if raw_source_mode() == "dir":
+        if not folder.exists():
+            return []
+        paths = folder.rglob(pattern) if recursive else folder.glob(pattern)
+        return [RawFile(p) for p in sorted(paths) if p.is_file()]
+
+    if not ZIP_FILE_PATH.exists():
+        return []
+    files = []
+    for raw_file in _iter_archive_files():
+        if not fnmatch.fnmatch(raw_file.name, pattern):
+            continue
+        if raw_file.parent == folder or (recursive and folder in raw_file.path.parents):
+            files.append(raw_file)
+    return sorted(files, key=lambda f: str(f.path))
+
+
+def raw_folder_exists(folder):
+    """True if `folder` exists in the current raw source."""
+    folder = Path(folder)
+    if raw_source_mode() == "dir":
+        return folder.exists()
+    if not ZIP_FILE_PATH.exists():
+        return False
+    return any(folder in raw_file.path.parents for raw_file in _iter_archive_files())
+
+
+class ConvertedRawFiles:
+    """
+    Size and mtime of every raw file a step converted, stored next to its
+    outputs (`state_path`); `outputs_for(file)` lists the outputs of a raw file.
+
+    With PIPELINE_CHANGED_RAW_ONLY=1, `select` keeps only the raw files that
+    changed since the step last converted them (or whose outputs are missing),
+    however many extractions ran in between. `settings` are stored with a file
+    and a file converted with other settings counts as changed. Outputs of raw
+    files that no longer exist are always deleted. Only the extracted folder
+    keeps this state; reading from the archive converts everything.
+    """
+
+    def __init__(self, state_path, outputs_for):
+        self.state_path = Path(state_path)
+        self.outputs_for = outputs_for
+        self.enabled = raw_source_mode() == "dir"
+        self.converted = {}
+        if self.enabled and self.state_path.exists():
+            with open(self.state_path) as f:
+                self.converted = json.load(f)
+
+    @staticmethod
+    def _key(raw_file):
+        return raw_file.path.relative_to(RAW_DATA_DIR).as_posix()
+
+    @staticmethod
+    def _fingerprint(raw_file, settings):
+        stat = raw_file.path.stat()
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "settings": settings}
+
+    def remove_orphaned(self):
+        """Deletes the outputs of converted raw files that are gone from data/raw."""
+        if not self.enabled:
+            return
+        for key in [k for k in self.converted if not (RAW_DATA_DIR / k).is_file()]:
+            for output in self.outputs_for(RawFile(RAW_DATA_DIR / key)):
+                Path(output).unlink(missing_ok=True)
+            del self.converted[key]
+            logger.info(f"Removed the outputs of {key}, which is no longer in the raw data")
+        self.save()
+
+    def select(self, raw_files, settings_for=lambda f: None):
+        """`raw_files` to convert: all of them, or with PIPELINE_CHANGED_RAW_ONLY=1 the changed ones."""
+        if os.environ.get("PIPELINE_CHANGED_RAW_ONLY") != "1":
+            return raw_files
+        if not self.enabled:
+            logger.warning("Raw files are read from the archive, processing all of them")
+            return raw_files
+        selected = [
+            f for f in raw_files
+            if self.converted.get(self._key(f)) != self._fingerprint(f, settings_for(f))
+            or not all(Path(output).exists() for output in self.outputs_for(f))
+        ]
+        logger.info(f"Limiting to {len(selected)}/{len(raw_files)} raw files changed since they were last converted")
+        return selected
+
+    def mark_converted(self, raw_file, settings=None):
+        if self.enabled:
+            self.converted[self._key(raw_file)] = self._fingerprint(raw_file, settings)
+
+    def save(self):
+        if not self.enabled:
+            return
+        tmp_path = self.state_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.converted, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
@@ -0,0 +1,33 @@
+"""
+CPU and memory budget of the running step, as set by the pipeline scheduler.
+
+Every step runs in its own interpreter. The scheduler passes the step's budget
+through the environment:
+
+PIPELINE_THREADS    total number of CPUs the step may keep busy
+PIPELINE_PROCESSES  number of worker processes for steps with a process pool
+PIPELINE_MEMORY_GB  memory the scheduler admitted the step with (not enforced)
+
+and sets POLARS_MAX_THREADS/RAYON_NUM_THREADS to the threads per process, so
+Polars is sized correctly before it is imported. A script started by hand
+without these variables uses every core and the memory that is available.
+"""
+import os
+
+import psutil
+
+
+def thread_budget():
+    return max(1, int(os.environ.get("PIPELINE_THREADS", os.cpu_count())))
+
+
+def process_budget():
+    return max(1, int(os.environ.get("PIPELINE_PROCESSES", thread_budget())))
+
+
+def memory_budget():
+    """Bytes the step may use: its reservation, but never more than is available right now."""
+    available = psutil.virtual_memory().available
+    if "PIPELINE_MEMORY_GB" not in os.environ:
+        return available
+    return min(available, int(float(os.environ["PIPELINE_MEMORY_GB"]) * 1024**3))
@@ -0,0 +1,52 @@
+"""
+Reading the security master written by step 05 (data/interim/security_master).
+
+links.parquet stores every Datastream-Worldscope link with the dates it is
+valid for:
+
+    ds_key, ws_key, valid_from, valid_to
+
+A link is valid from valid_from (inclusive) to valid_to (exclusive); a null
+valid_from means since the beginning of the data, a null valid_to that the link
+is still valid. The intervals of one ds_key do not overlap, so on any date a
+Datastream security has at most one Worldscope id.
+"""
+from datetime import date
+from pathlib import Path
+
+import polars as pl
+
+LINK_COLUMNS = ["ds_key", "ws_key", "valid_from", "valid_to"]
+
+
+def scan_links(master_dir):
+    """LazyFrame over the link intervals, sorted by ds_key and valid_from."""
+    return pl.scan_parquet(Path(master_dir) / "links.parquet")
+
+
+def join_links_asof(lf, links, on="Date"):
+    """
+    Attaches to every row of `lf` (with ds_key and the date column `on`) the
+    columns of the link valid on that date, null if there is none. This is a
+    backward as-of join of the rows, sorted by ds_key and date, on the sorted
+    interval starts, so each row matches at most one link and the result has
+    exactly the rows of `lf`.
+    """
+    date_type = lf.collect_schema()[on]
+    links = (
+        links
+        .with_columns(
+            pl.col("valid_from").fill_null(date.min).cast(date_type).alias("_start"),
+            pl.col("valid_to").cast(date_type),
+        )
+        .sort(["ds_key", "_start"])
+    )
+    values = [c for c in links.collect_schema().names() if c not in ("ds_key", "_start", "valid_from", "valid_to")]
+    joined = lf.sort(["ds_key", on]).join_asof(
+        links, left_on=on, right_on="_start", by="ds_key", strategy="backward", check_sortedness=False,
+    )
+    # The last link that started before the date may have ended already
+    expired = pl.col("valid_to").is_not_null() & (pl.col(on) >= pl.col("valid_to"))
+    return joined.with_columns(
+        pl.when(expired).then(None).otherwise(pl.col(c)).alias(c) for c in values
+    ).drop("_start", "valid_from", "valid_to")
@@ -0,0 +1,118 @@
+"""
+Bounded-memory merging of parquet files made of sorted runs.
+
+Step 02 writes every chunk of securities of a Datastream file as one row group
+sorted by DSCode and Date (a sorted run, flagged in the row group's
+sorting_columns). Step 06 reads the runs of a market value and a return file
+side by side, batch by batch, with `aligned_chunks`: all runs are cut at the
+smallest key any of them has buffered, so every chunk holds all rows of its
+keys from every run and can be joined on its own. Memory depends on the number
+of runs and the batch size, not on the size of the files.
+"""
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+def sorted_runs(path, sort_by, batch_rows):
+    """
+    Batch iterators over the sorted runs of the parquet file at `path`, one per
+    row group if every row group is flagged as sorted by `sort_by`. Files
+    without the flags (written before the runs were sorted) are read and sorted
+    in memory as a single run.
+    """
+    parquet_file = pq.ParquetFile(path, pre_buffer=False, buffer_size=1 << 20)
+    metadata = parquet_file.metadata
+    names = parquet_file.schema_arrow.names
+    expected = [names.index(column) for column in sort_by]
+    flagged = all(
+        [c.column_index for c in metadata.row_group(i).sorting_columns][:len(expected)] == expected
+        for i in range(metadata.num_row_groups)
+    )
+    if flagged:
+        return [
+            parquet_file.iter_batches(batch_size=batch_rows, row_groups=[i])
+            for i in range(metadata.num_row_groups)
+        ]
+    table = parquet_file.read().sort_by([(column, "ascending") for column in sort_by])
+    return [iter(table.to_batches(max_chunksize=batch_rows))]
+
+
+class _Run:
+    """The buffered rows of one sorted run, with their keys as a NumPy array for binary search."""
+
+    def __init__(self, batches, schema, key):
+        self.batches = batches
+        self.key = key
+        self.table = schema.empty_table()
+        self.keys = np.array([], dtype=object)
+        self.open = True
+
+    def read(self):
+        for batch in self.batches:
+            if batch.num_rows:
+                self.table = pa.concat_tables([self.table, pa.Table.from_batches([batch])])
+                keys = batch.column(self.key).to_numpy(zero_copy_only=False)
+                self.keys = np.concatenate([self.keys, keys.astype(object)])
+                return
+        self.open = False
+
+    def take_below(self, cut=None):
+        """Removes and returns the rows with a key below `cut` (all rows if None)."""
+        n = len(self.keys) if cut is None else int(np.searchsorted(self.keys, cut, side="left"))
+        head = self.table.slice(0, n)
+        self.table = self.table.slice(n)
+        self.keys = self.keys[n:]
+        return head
+
+
+def aligned_chunks(inputs, key, min_rows):
+    """
+    Merges the sorted runs of several inputs. `inputs` is a list of (schema,
+    runs) with the batch iterators of `sorted_runs`; the key column must not
+    contain nulls. Yields one table per input at a time, holding the rows of the
+    same consecutive key range from all runs of that input (at least `min_rows`
+    rows in total, except for the last chunk).
+    """
+    runs = [[_Run(batches, schema, key) for batches in input_runs] for schema, input_runs in inputs]
+    all_runs = [run for input_runs in runs for run in input_runs]
+    for run in all_runs:
+        run.read()
+    parts = [[] for _ in inputs]
+    buffered = 0
+
+    def flush():
+        return [pa.concat_tables(input_parts) for input_parts in parts]
+
+    while True:
+        open_runs = [run for run in all_runs if run.open]
+        if not open_runs:
+            break
+        empty = [run for run in open_runs if not len(run.keys)]
+        if empty:
+            for run in empty:
+                run.read()
+            continue
+
+        # The rows below the smallest last key of the open runs are complete in every run
+        cut = min(run.keys[-1] for run in open_runs)
+        taken = 0
+        for input_runs, input_parts in zip(runs, parts):
+            for run in input_runs:
+                head = run.take_below(cut)
+                input_parts.append(head)
+                taken += head.num_rows
+        buffered += taken
+        if not taken:
+            # Runs that only hold rows of key `cut` need more rows to pass it
+            for run in open_runs:
+                if run.keys[-1] == cut:
+                    run.read()
+        if buffered >= min_rows:
+            yield flush()
+            parts = [[] for _ in inputs]
+            buffered = 0
+
+    for input_runs, input_parts in zip(runs, parts):
+        input_parts.extend(run.take_below() for run in input_runs)
+    yield flush()
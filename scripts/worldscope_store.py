@@ -0,0 +1,93 @@
+"""
+Layout of the Worldscope data on disk.
+
+Step 11 writes the cleaned Worldscope values as a hive-partitioned dataset
+
+    data/interim/Worldscope_clean_items/file_type=WSFV/freq=A/item_code=7240/<part>.parquet
+
+in a single pass. The partition values are not stored in the files; they are
+read back from the paths, so a query that filters on file_type, freq or
+item_code only opens the matching folders. Values without a freq are stored
+under freq=__HIVE_DEFAULT_PARTITION__ and read back as null.
+
+The files of step 03 and the item store are sorted by item_code, ws_id and
+point_date (ws_key follows the order of ws_id) and written in row groups of
+ROW_GROUP_ROWS rows with column statistics and a page index, so readers that
+filter on an item, a few companies or a date range skip the other row groups
+and pages. Bloom filters on ws_id are added with PIPELINE_WS_BLOOM_FILTERS=1
+(`run_pipeline.py --ws-bloom-filters`).
+"""
+import os
+from pathlib import Path
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+PARTITION_COLUMNS = ["file_type", "freq", "item_code"]
+HIVE_SCHEMA = {"file_type": pl.String, "freq": pl.String, "item_code": pl.Int64}
+
+SORT_COLUMNS = ["item_code", "ws_id", "point_date"]
+ROW_GROUP_ROWS = 128 * 1024
+
+
+def bloom_filters():
+    return os.environ.get("PIPELINE_WS_BLOOM_FILTERS") == "1"
+
+
+def parquet_options(columns):
+    """Parquet writer options (ParquetWriter keywords) for a Worldscope file with `columns`."""
+    columns = list(columns)
+    options = {
+        "compression": "zstd",
+        "write_statistics": True,
+        "write_page_index": True,
+        # Polars sorts nulls first (null item codes and dates of unparseable rows)
+        "sorting_columns": [pq.SortingColumn(columns.index(c), nulls_first=True) for c in SORT_COLUMNS if c in columns],
+    }
+    if bloom_filters() and "ws_id" in columns:
+        options["bloom_filter_options"] = {"ws_id": {"ndv": ROW_GROUP_ROWS, "fpp": 0.05}}
+    return options
+
+
+def write_sorted(lf, path, schema):
+    """
+    Writes `lf` sorted by SORT_COLUMNS to `path` with `schema`, in row groups of
+    ROW_GROUP_ROWS; returns the number of rows written. The sort runs on the
+    streaming engine and rows with equal keys keep their order.
+    """
+    sort_by = [c for c in SORT_COLUMNS if c in schema.names]
+    rows = 0
+    buffered = []
+    with pq.ParquetWriter(path, schema, **parquet_options(schema.names)) as writer:
+        for df in lf.sort(sort_by, maintain_order=True).collect_batches(engine="streaming"):
+            # Batches are collected until they fill whole row groups
+            buffered.append(df.to_arrow().cast(schema))
+            rows += df.height
+            if sum(len(t) for t in buffered) >= ROW_GROUP_ROWS:
+                table = pa.concat_tables(buffered)
+                full = len(table) - len(table) % ROW_GROUP_ROWS
+                writer.write_table(table.slice(0, full), row_group_size=ROW_GROUP_ROWS)
+                buffered = [table.slice(full)]
+        rest = pa.concat_tables(buffered) if buffered else None
+        if rest is not None and len(rest):
+            writer.write_table(rest, row_group_size=ROW_GROUP_ROWS)
+    return rows
+
+
+def scan_items(path, item_codes=None, freqs=None, file_types=None):
+    """LazyFrame over the Worldscope items at `path`, restricted to the given partitions."""
+    lf = pl.scan_parquet(Path(path), hive_partitioning=True, hive_schema=HIVE_SCHEMA)
+    if file_types is not None:
+        lf = lf.filter(pl.col("file_type").is_in(list(file_types)))
+    if freqs is not None:
+        lf = lf.filter(pl.col("freq").is_in(list(freqs)))
+    if item_codes is not None:
+        lf = lf.filter(pl.col("item_code").is_in(list(item_codes)))
+    return lf
+
+
+def available_item_codes(path, file_type="WSFV"):
+    """Item codes with at least one partition for `file_type`, from the folder names."""
+    folders = Path(path).glob(f"file_type={file_type}/freq=*/item_code=*")
+    return sorted({int(folder.name.split("=", 1)[1]) for folder in folders})
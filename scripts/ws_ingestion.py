@@ -0,0 +1,88 @@
+"""
+Which Worldscope files and item codes step 03 converts.
+
+Downstream only the WSFV values and the period items merged in by step 08 are
+read, so by default step 03 converts
+
+WSFV            the items used by the anomaly definitions in anomaly_config.py
+WSCalendarPrd   the period items used after the merge (PERIOD_ITEMS)
+WSReportedPrd   the period items used after the merge (PERIOD_ITEMS)
+
+and skips all other file types (footnotes, pricing, segments, ...). Rows of
+other item codes are dropped while the file is parsed. With
+PIPELINE_WS_INGEST=all (`run_pipeline.py --ws-ingest all`) every file and item
+is converted.
+
+Step 03 also parses the value of every row once, by item type, into
+
+value        Float64, numeric items (all items not listed below)
+value_date   Date, DATE_ITEMS (stored as dyyyymmdd)
+value_text   String, TEXT_ITEMS, and the values of numeric items that are not numbers
+
+so later steps use the typed columns instead of parsing the strings again.
+"""
+import os
+
+from anomaly_config import ANOMALIES, COLUMN_MAP
+
+# Columns of every Worldscope file type; the .txt files have no header
+WS_FILE_COLUMNS = {
+    "WSCalendarPrd":             ["ws_id", "point_date", "freq", "fiscal_period", "item_code", "value"],
+    "WSCurrent":                 ["ws_id", "point_date", "item_code", "value"],
+    "WSCurrentFootnote":         ["ws_id", "point_date", "item_code", "note"],
+    "WSFV":                      ["ws_id", "point_date", "freq", "fiscal_period", "item_code", "value"],
+    "WSFVFootnote":              ["ws_id", "point_date", "freq", "fiscal_period", "item_code", "note"],
+    "WSIndex":                   ["ws_id", "point_date", "index_name", "item_code", "value"],
+    "WSMetaData":                ["ws_id", "point_date", "freq", "fiscal_period", "item_code", "value"],
+    "WSMetaDataFootnote":        ["ws_id", "point_date", "freq", "fiscal_period", "item_code", "note"],
+    "WSMonthlyPricing":          ["ws_id", "point_date", "item_code", "value"],
+    "WSMonthlyPricingFootnote":  ["ws_id", "point_date", "item_code", "note"],
+    "WSRatios":                  ["ws_id", "point_date", "freq", "fiscal_period", "item_code", "value"],
+    "WSRatiosFootnote":          ["ws_id", "point_date", "freq", "fiscal_period", "item_code", "note"],
+    "WSReportedPrd":             ["ws_id", "point_date", "freq", "item_code", "value"],
+    "WSSegment":                 ["ws_id", "point_date", "freq", "fiscal_period", "segment_type", "segment_id", "item_code", "value"],
+    "WSSegmentFootnote":         ["ws_id", "point_date", "freq", "fiscal_period", "segment_type", "segment_id", "item_code", "note"],
+    "WSSupplemental":            ["ws_id", "point_date", "freq", "fiscal_period", "item_code", "value"],
+    "WSSupplementalFootnote":    ["ws_id", "point_date", "freq", "fiscal_period", "item_code", "note"],
+    "WSWeeklyPricing":           ["ws_id", "point_date", "item_code", "value"],
+    "WSWeeklyPricingFootnote":   ["ws_id", "point_date", "item_code", "note"],
+}
+
+# Items of the period files used after step 08 merged them in as cal1_/cal2_ columns:
+# 55350 fiscal year end (13-15), 55555 (10), 55558/55559 (09)
+PERIOD_ITEMS = {
+    "WSCalendarPrd": {55350, 55555},
+    "WSReportedPrd": {55558, 55559},
+}
+
+# Items whose values are not numbers
+DATE_ITEMS = {55350, 55352}
+TEXT_ITEMS = {55555, 55558, 55559, 57034}
+
+
+def value_column(item_code):
+    """Typed value column of `item_code`."""
+    if item_code in DATE_ITEMS:
+        return "value_date"
+    if item_code in TEXT_ITEMS:
+        return "value_text"
+    return "value"
+
+
+def ingest_all():
+    return os.environ.get("PIPELINE_WS_INGEST", "plan") == "all"
+
+
+def anomaly_items():
+    """Item codes the anomaly definitions read (COLUMN_MAP and every anomaly's inputs)."""
+    return set(COLUMN_MAP) | {code for cfg in ANOMALIES.values() for code in cfg["inputs"]}
+
+
+def ingestion_plan():
+    """
+    {file type: item codes to keep} for the file types to convert, or None to
+    convert everything.
+    """
+    if ingest_all():
+        return None
+    return {"WSFV": anomaly_items(), **PERIOD_ITEMS}
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The scripts import their helper modules (raw_source, ws_ingestion, ...) by name
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "scripts"))
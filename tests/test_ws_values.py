@@ -0,0 +1,47 @@
+import datetime
+import importlib.util
+from pathlib import Path
+
+import pyarrow as pa
+
+from ws_ingestion import DATE_ITEMS, TEXT_ITEMS
+
+SCRIPT = Path(__file__).resolve().parents[1] / "scripts" / "03_process_ws.py"
+spec = importlib.util.spec_from_file_location("process_ws", SCRIPT)
+process_ws = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(process_ws)
+
+COLUMNS = ["ws_id", "point_date", "freq", "fiscal_period", "item_code", "value"]
+
+
+def split(items, values):
+    parse_schema = process_ws.ws_schema(COLUMNS)
+    table = pa.table({
+        "ws_id": ["C1"] * len(items),
+        "point_date": pa.array([datetime.datetime(2024, 3, 31)] * len(items), pa.timestamp("us")),
+        "freq": ["A"] * len(items),
+        "fiscal_period": pa.array([2023] * len(items), pa.int64()),
+        "item_code": pa.array(items, pa.int64()),
+        "value": values,
+    }, schema=parse_schema)
+    return process_ws.WorldscopeProcessor.split_values(table, process_ws.output_schema(COLUMNS)).to_pydict()
+
+
+def test_quoted_numbers_are_numbers():
+    result = split([7240, 7240, 7240], ['"1234.5"', ' "-0.25" ', '"1e3"'])
+    assert result["value"] == [1234.5, -0.25, 1000.0]
+    assert result["value_text"] == [None, None, None]
+
+
+def test_quoted_dates_are_dates():
+    date_item = min(DATE_ITEMS)
+    result = split([date_item, date_item], ['"d20231231"', '"20230630"'])
+    assert result["value_date"] == [datetime.date(2023, 12, 31), datetime.date(2023, 6, 30)]
+    assert result["value"] == [None, None]
+
+
+def test_quoted_text_loses_the_quotes():
+    text_item = min(TEXT_ITEMS)
+    result = split([text_item, 7240], ['"s2023"', '"n/a"'])
+    assert result["value_text"] == ["s2023", "n/a"]
+    assert result["value"] == [None, None]